@@ -0,0 +1,236 @@
+import datetime
+import hashlib
+import itertools
+import threading
+import time
+import boto
+import simplejson
+
+
+class FakeValue:
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class FakeResource:
+    def __init__(self, stack_name, logical_resource_id, physical_resource_id, resource_type):
+        self.stack_name = stack_name
+        self.logical_resource_id = logical_resource_id
+        self.physical_resource_id = physical_resource_id
+        self.resource_type = resource_type
+        self.resource_status = "CREATE_COMPLETE"
+
+
+class FakeEvent:
+    def __init__(self, event_id, stack_name, logical_resource_id, physical_resource_id, resource_type, resource_status):
+        self.event_id = event_id
+        self.timestamp = datetime.datetime.utcnow()
+        self.stack_name = stack_name
+        self.logical_resource_id = logical_resource_id
+        self.physical_resource_id = physical_resource_id
+        self.resource_type = resource_type
+        self.resource_status = resource_status
+        self.resource_status_reason = None
+
+
+class FakeResultSet(list):
+    def __init__(self, items = (), next_token = None):
+        list.__init__(self, items)
+        self.next_token = next_token
+
+
+class FakeStack:
+    """
+    A stack in the fake region, with the attributes cumulus uses from boto stack objects
+    """
+    def __init__(self, stack_name, template_body, parameters, tags):
+        self.stack_name = stack_name
+        self.stack_id = "arn:aws:cloudformation:fake:000000000000:stack/%s/%s" % (stack_name, hashlib.sha1(stack_name).hexdigest())
+        self.stack_status = "CREATE_IN_PROGRESS"
+        self.creation_time = datetime.datetime.utcnow()
+        #boto keeps LastUpdatedTime as the string cloudformation returns, and only sets it once the stack is updated
+        self.tags = dict(tags or {})
+        self.events = []
+        #When the operation in progress finishes
+        self.done_at = 0
+        self.set_template(template_body, parameters)
+
+    def set_template(self, template_body, parameters):
+        self.template_body = template_body
+        self.parameters = [FakeValue(key, value) for key, value in parameters]
+        template = simplejson.loads(template_body)
+        self.resources = [
+            FakeResource(self.stack_name, logical_id, "%s-%s-%s" % (self.stack_name, logical_id, hashlib.sha1(self.stack_name + logical_id).hexdigest()[:12]), resource.get('Type'))
+            for logical_id, resource in sorted(template.get('Resources', {}).items())
+        ]
+        self.outputs = [FakeValue(key, "%s-%s" % (self.stack_name, key)) for key in sorted(template.get('Outputs', {}).keys())]
+
+
+class FakeCloudFormation:
+    """
+    In-process stand in for the cloudformation API of a single region, for benchmarking cumulus without AWS.
+    Supports the calls cumulus makes, pages results the way cloudformation does, and counts every call.
+    Each call sleeps for latency seconds before answering, calls over max_calls_per_second are rejected
+    with a Throttling error, and creates, updates and deletes finish stack_delay seconds after they start.
+    Use connect in place of cloudformation.connect_to_region, e.g. CFConnectionPool(connect=fake.connect).
+    Templates passed by URL are read from s3, a FakeS3, so it needs to be given one to use template_url.
+    """
+    PAGE_SIZE = 100
+
+    def __init__(self, latency = 0, max_calls_per_second = None, stack_delay = 0, s3 = None):
+        self.latency = latency
+        self.s3 = s3
+        self.max_calls_per_second = max_calls_per_second
+        self.stack_delay = stack_delay
+        self.lock = threading.Lock()
+        self.stacks = {}
+        #Number of calls made, keyed by API call
+        self.calls = {}
+        self.throttled = 0
+        self.event_ids = itertools.count()
+        self.throttle_window = (0, 0)
+
+    def connect(self, region, **kwargs):
+        return self
+
+    def error(self, code, message):
+        body = simplejson.dumps({'Error': {'Type': 'Sender', 'Code': code, 'Message': message}})
+        e = boto.exception.BotoServerError(400, 'Bad Request', body)
+        e.error_code = code
+        e.error_message = body
+        return e
+
+    def call(self, name):
+        """
+        Count a call, wait for the latency and apply throttling
+        """
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.max_calls_per_second:
+                second, count = self.throttle_window
+                now = int(time.time())
+                if now != second:
+                    second, count = now, 0
+                count += 1
+                self.throttle_window = (second, count)
+                if count > self.max_calls_per_second:
+                    self.throttled += 1
+                    raise self.error('Throttling', 'Rate exceeded')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls = {}
+            self.throttled = 0
+
+    def add_event(self, stack, status):
+        event_id = str(self.event_ids.next())
+        stack.events.insert(0, FakeEvent(event_id, stack.stack_name, stack.stack_name, stack.stack_id, "AWS::CloudFormation::Stack", status))
+
+    def tick(self):
+        """
+        Finish any operations that are due. Needs self.lock.
+        """
+        now = time.time()
+        for stack in self.stacks.values():
+            if stack.stack_status.endswith("_IN_PROGRESS") and now >= stack.done_at:
+                stack.stack_status = stack.stack_status.replace("_IN_PROGRESS", "_COMPLETE")
+                self.add_event(stack, stack.stack_status)
+                if stack.stack_status == "DELETE_COMPLETE":
+                    del self.stacks[stack.stack_name]
+
+    def get_stack(self, name):
+        self.tick()
+        if name not in self.stacks:
+            raise self.error('ValidationError', "Stack:%s does not exist" % name)
+        return self.stacks[name]
+
+    def page(self, items, next_token):
+        start = int(next_token or 0)
+        end = start + self.PAGE_SIZE
+        return FakeResultSet(items[start:end], str(end) if end < len(items) else None)
+
+    def template_body(self, template_body, template_url):
+        if template_body is not None:
+            return template_body
+        if self.s3 is None:
+            raise self.error('ValidationError', "Template URLs need a FakeS3 to read from: %s" % template_url)
+        template_body = self.s3.read_url(template_url)
+        if template_body is None:
+            raise self.error('ValidationError', "TemplateURL must reference a valid S3 object to which you have access: %s" % template_url)
+        return template_body
+
+    def describe_stacks(self, stack_name_or_id = None, next_token = None):
+        self.call('describe_stacks')
+        with self.lock:
+            if stack_name_or_id:
+                return FakeResultSet([self.get_stack(stack_name_or_id)])
+            self.tick()
+            return self.page(sorted(self.stacks.values(), key=lambda stack: stack.stack_name), next_token)
+
+    def describe_stack_events(self, stack_name_or_id = None, next_token = None):
+        self.call('describe_stack_events')
+        with self.lock:
+            return self.page(list(self.get_stack(stack_name_or_id).events), next_token)
+
+    def list_stack_resources(self, stack_name_or_id, next_token = None):
+        self.call('list_stack_resources')
+        with self.lock:
+            return self.page(list(self.get_stack(stack_name_or_id).resources), next_token)
+
+    def get_template(self, stack_name_or_id):
+        self.call('get_template')
+        with self.lock:
+            return {'GetTemplateResponse': {'GetTemplateResult': {'TemplateBody': self.get_stack(stack_name_or_id).template_body}}}
+
+    def validate_template(self, template_body = None, template_url = None):
+        self.call('validate_template')
+        simplejson.loads(self.template_body(template_body, template_url))
+        return True
+
+    def create_stack(self, stack_name, template_body = None, template_url = None, parameters = (), notification_arns = (), disable_rollback = False, timeout_in_minutes = None, capabilities = None, tags = None, **kwargs):
+        self.call('create_stack')
+        template_body = self.template_body(template_body, template_url)
+        with self.lock:
+            self.tick()
+            if stack_name in self.stacks:
+                raise self.error('AlreadyExistsException', "Stack [%s] already exists" % stack_name)
+            stack = FakeStack(stack_name, template_body, parameters, tags)
+            stack.done_at = time.time() + self.stack_delay
+            self.stacks[stack_name] = stack
+            self.add_event(stack, "CREATE_IN_PROGRESS")
+            self.tick()
+            return stack.stack_id
+
+    def update_stack(self, stack_name, template_body = None, template_url = None, parameters = (), notification_arns = (), disable_rollback = False, timeout_in_minutes = None, capabilities = None, tags = None, **kwargs):
+        self.call('update_stack')
+        template_body = self.template_body(template_body, template_url)
+        with self.lock:
+            stack = self.get_stack(stack_name)
+            if stack.stack_status.endswith("_IN_PROGRESS"):
+                raise self.error('ValidationError', "Stack:%s is in %s state and can not be updated." % (stack_name, stack.stack_status))
+            if template_body == stack.template_body and list(parameters) == [(p.key, p.value) for p in stack.parameters]:
+                raise self.error('ValidationError', "No updates are to be performed.")
+            stack.set_template(template_body, parameters)
+            if tags:
+                stack.tags = dict(tags)
+            stack.stack_status = "UPDATE_IN_PROGRESS"
+            stack.LastUpdatedTime = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            stack.done_at = time.time() + self.stack_delay
+            self.add_event(stack, "UPDATE_IN_PROGRESS")
+            self.tick()
+            return stack.stack_id
+
+    def delete_stack(self, stack_name_or_id):
+        self.call('delete_stack')
+        with self.lock:
+            self.tick()
+            stack = self.stacks.get(stack_name_or_id)
+            if stack is None:
+                return
+            stack.stack_status = "DELETE_IN_PROGRESS"
+            stack.done_at = time.time() + self.stack_delay
+            self.add_event(stack, "DELETE_IN_PROGRESS")
+            self.tick()
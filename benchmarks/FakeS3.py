@@ -0,0 +1,77 @@
+import threading
+
+
+class FakeKey:
+    def __init__(self, s3, bucket_name, name):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.name = name
+
+    def set_contents_from_string(self, contents, headers = None):
+        self.s3.call('put_object')
+        with self.s3.lock:
+            self.s3.objects[(self.bucket_name, self.name)] = contents
+
+    def generate_url(self, expires_in, query_auth = True):
+        return self.s3.url(self.bucket_name, self.name)
+
+
+class FakeBucket:
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+
+    def get_key(self, key_name):
+        self.s3.call('head_object')
+        with self.s3.lock:
+            if (self.name, key_name) not in self.s3.objects:
+                return None
+        return FakeKey(self.s3, self.name, key_name)
+
+    def new_key(self, key_name):
+        return FakeKey(self.s3, self.name, key_name)
+
+
+class FakeS3:
+    """
+    In-process stand in for the parts of S3 cumulus uses to store templates, so templates passed by URL
+    can be benchmarked and tried out without AWS. Objects are kept in memory and every call is counted.
+    Pass it as s3conn to TemplateStore (or MegaStack) and as s3 to FakeCloudFormation, which reads
+    template URLs back from it.
+    """
+    URL_FORMAT = "https://%s.s3.amazonaws.com/%s"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #Object contents keyed by (bucket name, key name)
+        self.objects = {}
+        #Number of calls made, keyed by API call
+        self.calls = {}
+
+    def connect(self, region, **kwargs):
+        return self
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls = {}
+
+    def get_bucket(self, bucket_name, validate = True):
+        return FakeBucket(self, bucket_name)
+
+    def url(self, bucket_name, key_name):
+        return self.URL_FORMAT % (bucket_name, key_name)
+
+    def read_url(self, url):
+        """
+        Contents of the object a URL from generate_url points at, or None if there's no such object.
+        Used by FakeCloudFormation, so not counted as a call.
+        """
+        with self.lock:
+            for (bucket_name, key_name), contents in self.objects.items():
+                if self.url(bucket_name, key_name) == url:
+                    return contents
+        return None
@@ -0,0 +1,107 @@
+import os
+import simplejson
+import yaml
+
+
+class SyntheticMegaStack:
+    """
+    Writes a made up mega stack yaml file, and the template its stacks use, for benchmarking.
+    Every stack takes a list param of outputs and a param of a resource from the stacks it depends on,
+    so resolving parameters costs what it would in a real mega stack. The shape decides the dependencies:
+        flat     every stack depends on the first one
+        chain    every stack depends on the one before it
+        tree     binary tree, every stack depends on its parent
+        layered  layers of 10 stacks, every stack depends on two stacks in the layer before
+    If template_bucket is set the templates are passed to cloudformation by URL from that bucket.
+    """
+    SHAPES = ('flat', 'chain', 'tree', 'layered')
+    LAYER_WIDTH = 10
+
+    def __init__(self, count, shape, name = 'bench', region = 'us-east-1', resources = 5, version = 1, template_bucket = None):
+        if shape not in self.SHAPES:
+            raise ValueError("Unknown shape %s, must be one of %s" % (shape, ", ".join(self.SHAPES)))
+        self.count = count
+        self.shape = shape
+        self.name = name
+        self.region = region
+        self.resources = resources
+        #Static param passed to every stack, changing it makes every stack need an update
+        self.version = version
+        self.template_bucket = template_bucket
+
+    def stack_name(self, i):
+        return "s%04d" % i
+
+    def depends(self, i):
+        """
+        Indexes of the stacks stack i depends on
+        """
+        if i == 0:
+            return []
+        if self.shape == 'flat':
+            return [0]
+        if self.shape == 'chain':
+            return [i - 1]
+        if self.shape == 'tree':
+            return [(i - 1) / 2]
+        layer = i / self.LAYER_WIDTH
+        if layer == 0:
+            return [0]
+        previous = (layer - 1) * self.LAYER_WIDTH
+        deps = sorted(set([previous + i % self.LAYER_WIDTH, previous + (i + 1) % self.LAYER_WIDTH]))
+        if layer == 1 and 0 in deps and len(deps) > 1:
+            #The rest of the first layer already depends on stack 0
+            deps.remove(0)
+        return deps
+
+    def template(self):
+        resources = {}
+        outputs = {}
+        for r in range(self.resources):
+            resources["Topic%s" % r] = {"Type": "AWS::SNS::Topic", "Properties": {"DisplayName": {"Fn::Join": ["-", [{"Ref": "AWS::StackName"}, str(r)]]}}}
+        for o in range(2):
+            outputs["Out%s" % o] = {"Value": {"Ref": "Topic%s" % o}}
+        return {
+            "AWSTemplateFormatVersion": "2010-09-09",
+            "Parameters": {
+                "Version": {"Type": "String"},
+                "Inputs": {"Type": "CommaDelimitedList"},
+                "Topic": {"Type": "String", "Default": ""},
+            },
+            "Resources": resources,
+            "Outputs": outputs,
+        }
+
+    def stacks(self, template_path):
+        stacks = {}
+        for i in range(self.count):
+            deps = [self.stack_name(d) for d in self.depends(i)]
+            params = {'Version': {'value': self.version}}
+            if deps:
+                params['Inputs'] = [{'source': dep, 'type': 'output', 'variable': 'Out0'} for dep in deps]
+                params['Topic'] = {'source': deps[0], 'type': 'resource', 'variable': 'Topic0'}
+            else:
+                params['Inputs'] = [{'value': 'none'}]
+            stacks[self.stack_name(i)] = {
+                'cf_template': template_path,
+                'depends': deps or None,
+                'params': params,
+            }
+        return stacks
+
+    def write(self, directory, file_name = None):
+        """
+        Write the template and yaml file to directory, returns the path of the yaml file
+        """
+        template_path = os.path.abspath(os.path.join(directory, "%s-template.json" % self.name))
+        template_file = open(template_path, 'w')
+        simplejson.dump(self.template(), template_file, indent=2, sort_keys=True)
+        template_file.close()
+        yaml_path = os.path.join(directory, file_name or "%s-%s-%s.yaml" % (self.name, self.shape, self.count))
+        yaml_file = open(yaml_path, 'w')
+        mega_stack = {'region': self.region, 'stacks': self.stacks(template_path)}
+        if self.template_bucket:
+            mega_stack['template-bucket'] = self.template_bucket
+        yaml.safe_dump({self.name: mega_stack}, yaml_file, default_flow_style=False)
+        yaml_file.close()
+        return yaml_path
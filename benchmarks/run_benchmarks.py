@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Benchmarks cumulus against an in-process fake cloudformation, reporting the wall clock time and the
+number of API calls for each action on synthetic mega stacks of different sizes and shapes.
+
+    python benchmarks/run_benchmarks.py --sizes 10,100 --shapes flat,chain --latency 0.01
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os.path import dirname, abspath
+
+# Add one directory up to python path, so it can find cumulus package
+BENCH_DIR = dirname(abspath(__file__))
+ROOT_DIR = dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+import simplejson
+from cumulus.CFConnectionPool import CFConnectionPool
+from cumulus.InputManifest import InputManifest
+from cumulus.MegaStack import MegaStack
+from FakeCloudFormation import FakeCloudFormation
+from FakeS3 import FakeS3
+from SyntheticMegaStack import SyntheticMegaStack
+
+#check runs after create, so there are stacks to resolve parameters from
+#update is a no-op update of stacks that haven't changed, update-changed bumps a param on every stack,
+#update-changed-only is a no-op update of the yaml file last applied, that only checks stacks the input manifest says have changed
+ACTIONS = ['create', 'check', 'update', 'update-changed', 'update-changed-only', 'delete']
+
+
+def run_action(action, yaml_files, fake, args, input_manifest, fake_s3 = None):
+    """
+    Run one action the way the command line would, returns (seconds, calls, ok).
+    Calls to fake_s3, if templates are passed by URL, are counted with an s3: prefix.
+    """
+    fake.reset_counts()
+    if fake_s3 is not None:
+        fake_s3.reset_counts()
+    start = time.time()
+    ok = True
+    try:
+        pool = CFConnectionPool(size=args.pool_size, connect=fake.connect, read_rate=args.read_rate, write_rate=args.write_rate, max_retries=args.max_retries)
+        if action == 'update-changed-only':
+            yaml_file = yaml_files.get('applied', yaml_files['base'])
+        else:
+            yaml_file = yaml_files['changed'] if action == 'update-changed' else yaml_files['base']
+            if action != 'check':
+                yaml_files['applied'] = yaml_file
+        the_mega_stack = MegaStack(yaml_file, cf_pool=pool, input_manifest=input_manifest, s3conn=fake_s3)
+        the_mega_stack.sort_stacks_by_deps()
+        if action == 'check':
+            the_mega_stack.check()
+        elif action == 'create':
+            the_mega_stack.create(parallel=args.parallel)
+        elif action in ('update', 'update-changed'):
+            the_mega_stack.update(parallel=args.parallel)
+        elif action == 'update-changed-only':
+            the_mega_stack.update(parallel=args.parallel, changed_only=True)
+        elif action == 'delete':
+            the_mega_stack.delete(parallel=args.parallel, assume_yes=True)
+    except SystemExit:
+        ok = False
+    except Exception as e:
+        logging.getLogger(__name__).error("%s failed: %s" % (action, e))
+        ok = False
+    calls = dict(fake.calls)
+    if fake_s3 is not None:
+        calls.update([("s3:%s" % name, count) for name, count in fake_s3.calls.items()])
+    return time.time() - start, calls, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cumulus against a fake cloudformation")
+    parser.add_argument("--sizes", default="10,100,1000", help="Comma separated numbers of stacks. Default is 10,100,1000")
+    parser.add_argument("--shapes", default=",".join(SyntheticMegaStack.SHAPES), help="Comma separated dependency shapes: %s" % ", ".join(SyntheticMegaStack.SHAPES))
+    parser.add_argument("--actions", default=",".join(ACTIONS), help="Comma separated actions to run in order: %s" % ", ".join(ACTIONS))
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each fake API call takes. Default is 0")
+    parser.add_argument("--stack-delay", dest="stack_delay", type=float, default=0.0, help="Seconds creates, updates and deletes take to finish. Includes cumulus' polling, so keep this 0 to measure cumulus itself. Default is 0")
+    parser.add_argument("--throttle", type=int, default=None, help="Reject API calls over this many per second with a Throttling error. Default is no throttling")
+    parser.add_argument("--template-bucket", dest="template_bucket", help="Pass templates to cloudformation by URL, stored in this bucket of a fake S3. Default is to pass them inline")
+    parser.add_argument("--resources", type=int, default=5, help="Resources in each stack's template. Default is 5")
+    parser.add_argument("-p", "--parallel", type=int, default=1, help="Stacks to work on at once. Default is 1")
+    parser.add_argument("--pool-size", dest="pool_size", type=int, default=10, help="Concurrent connections to the fake cloudformation. Default is 10")
+    parser.add_argument("--read-rate", dest="read_rate", type=float, default=None, help="Limit cumulus to this many read calls per second. Default is no limit")
+    parser.add_argument("--write-rate", dest="write_rate", type=float, default=None, help="Limit cumulus to this many calls per second that change stacks. Default is no limit")
+    parser.add_argument("--max-retries", dest="max_retries", type=int, default=5, help="Times cumulus retries throttled calls. Default is 5")
+    parser.add_argument("--json", dest="json_file", help="Also write the results to this file as JSON")
+    parser.add_argument("-l", "--log", dest="loglevel", default="warning", help="Log level for cumulus. Default is WARNING")
+    args = parser.parse_args()
+
+    actions = args.actions.split(',')
+    for action in actions:
+        if action not in ACTIONS:
+            print "Invalid action %s, must be one of: %s" % (action, ", ".join(ACTIONS))
+            exit(1)
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper(), logging.WARNING))
+
+    results = []
+    print "%6s %-8s %-19s %9s %7s %9s %7s  %s" % ("stacks", "shape", "action", "seconds", "calls", "throttled", "status", "calls by API")
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for shape in args.shapes.split(','):
+            work_dir = tempfile.mkdtemp(prefix="cumulus-bench-")
+            try:
+                yaml_files = {
+                    'base': SyntheticMegaStack(size, shape, resources=args.resources, template_bucket=args.template_bucket).write(work_dir),
+                    'changed': SyntheticMegaStack(size, shape, resources=args.resources, version=2, template_bucket=args.template_bucket).write(work_dir, "changed.yaml"),
+                }
+                fake_s3 = FakeS3() if args.template_bucket else None
+                fake = FakeCloudFormation(latency=args.latency, max_calls_per_second=args.throttle, stack_delay=args.stack_delay, s3=fake_s3)
+                input_manifest = InputManifest(os.path.join(work_dir, "bench.manifest"))
+                for action in actions:
+                    seconds, calls, ok = run_action(action, yaml_files, fake, args, input_manifest, fake_s3)
+                    status = "ok" if ok else "FAILED"
+                    print "%6s %-8s %-19s %9.3f %7s %9s %7s  %s" % (size, shape, action, seconds, sum(calls.values()), fake.throttled, status,
+                            ", ".join(["%s=%s" % (name, count) for name, count in sorted(calls.items())]))
+                    sys.stdout.flush()
+                    results.append({
+                        'stacks': size,
+                        'shape': shape,
+                        'action': action,
+                        'seconds': seconds,
+                        'calls': calls,
+                        'throttled': fake.throttled,
+                        'ok': ok,
+                    })
+            finally:
+                shutil.rmtree(work_dir)
+
+    if args.json_file:
+        json_file = open(args.json_file, 'w')
+        simplejson.dump({'options': vars(args), 'results': results}, json_file, indent=2, sort_keys=True)
+        json_file.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import logging
+import random
+import threading
+import time
+import boto
+from boto import cloudformation
+from CallMetrics import CallMetrics, current_stack, payload_size
+from TokenBucket import TokenBucket
+
+
+#Error codes AWS uses for throttled calls, cloudformation itself sends Throttling with the message "Rate exceeded"
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded')
+
+
+def is_throttle(e):
+    """
+    Whether a BotoServerError means the call was throttled, so it can be retried and is counted as throttled
+    """
+    return e.error_code in THROTTLE_CODES or "Rate exceeded" in str(e.error_message)
+
+
+def paginate(call, *args, **kwargs):
+    """
+    Yield every item returned by a paged cloudformation call, like describe_stacks or list_stack_resources,
+    following next_token from page to page. Pages are only fetched as the items are used, so stopping early
+    saves the calls for the rest. max_pages limits how many pages are fetched.
+    """
+    max_pages = kwargs.pop('max_pages', None)
+    next_token = None
+    pages = 0
+    while True:
+        page = call(*args, next_token = next_token, **kwargs)
+        pages += 1
+        for item in page:
+            yield item
+        next_token = getattr(page, 'next_token', None)
+        if not next_token or (max_pages and pages >= max_pages):
+            return
+
+
+class PooledConnection:
+    """
+    Wraps a boto cloudformation connection so it can be shared between threads.
+    boto keeps idle HTTP connections open and reuses them, opening a new one whenever every
+    existing one is busy. Limiting the number of calls in flight to size means at most size
+    keep-alive connections are opened to the region, while concurrent workers don't have to
+    wait on each other for a single socket.
+    Calls are rate limited by token buckets shared by every thread, read calls (describe, list, get,
+    validate) and calls that change stacks have separate buckets, so heavy polling can't hold up
+    creates, updates and deletes. Throttled calls are retried up to max_retries times with exponential
+    backoff and jitter.
+    Every call is timed and recorded in metrics, if given.
+    """
+    READ_PREFIXES = ('describe_', 'list_', 'get_', 'validate_', 'estimate_')
+
+    def __init__(self, connection, size, metrics = None, read_bucket = None, write_bucket = None, max_retries = 5, base_delay = 1, max_delay = 30):
+        self.logger = logging.getLogger(__name__)
+        self.connection = connection
+        self.slots = threading.BoundedSemaphore(size)
+        self.metrics = metrics
+        self.read_bucket = read_bucket
+        self.write_bucket = write_bucket
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def bucket(self, name):
+        if name.startswith(self.READ_PREFIXES):
+            return self.read_bucket
+        return self.write_bucket
+
+    def retry_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2.0, delay)
+
+    def call_stack(self, args, kwargs):
+        """
+        The stack to tag a call with, the one the thread is working on or else the one the call is about
+        """
+        stack = current_stack()
+        if stack:
+            return stack
+        stack = kwargs.get('stack_name') or kwargs.get('stack_name_or_id')
+        if not stack and args and isinstance(args[0], basestring):
+            stack = args[0]
+        return stack
+
+    def timed_call(self, name, attr, args, kwargs):
+        if self.metrics is None:
+            return attr(*args, **kwargs)
+        start = time.time()
+        error_code = None
+        throttled = False
+        result = None
+        try:
+            result = attr(*args, **kwargs)
+            return result
+        except boto.exception.BotoServerError as e:
+            error_code = e.error_code or str(e.status)
+            throttled = is_throttle(e)
+            raise
+        except Exception as e:
+            error_code = e.__class__.__name__
+            raise
+        finally:
+            self.metrics.record(
+                operation = name,
+                stack = self.call_stack(args, kwargs),
+                seconds = time.time() - start,
+                request_bytes = payload_size(list(args) + kwargs.values()),
+                response_bytes = payload_size(result) if isinstance(result, (basestring, dict)) else 0,
+                response_items = len(result) if isinstance(result, list) else 0,
+                error_code = error_code,
+                throttled = throttled
+            )
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if not callable(attr):
+            return attr
+        bucket = self.bucket(name)
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                if bucket is not None:
+                    bucket.acquire()
+                try:
+                    with self.slots:
+                        return self.timed_call(name, attr, args, kwargs)
+                except boto.exception.BotoServerError as e:
+                    if not is_throttle(e) or attempt >= self.max_retries:
+                        raise
+                    attempt += 1
+                    if bucket is not None:
+                        bucket.drain()
+                    delay = self.retry_delay(attempt)
+                    self.logger.debug("Throttled calling %s, retrying in %.1f seconds (retry %s of %s)" % (name, delay, attempt, self.max_retries))
+                    if self.metrics is not None:
+                        self.metrics.record_retry(name, self.call_stack(args, kwargs))
+                    time.sleep(delay)
+        return call
+
+
+class CFConnectionPool:
+    """
+    Thread safe, region keyed pool of cloudformation connections. Owned by MegaStack and handed to
+    every CFStack, so each region is only connected to once per run, no matter how many stacks
+    or worker threads use it. Calls through the pool are recorded in metrics.
+    read_rate and write_rate limit the calls per second to each region, for read calls and calls that
+    change stacks. None means no limit.
+    """
+    def __init__(self, size = 10, connect = cloudformation.connect_to_region, metrics = None, read_rate = None, write_rate = None, max_retries = 5):
+        self.logger = logging.getLogger(__name__)
+        self.size = max(1, size)
+        #Function used to make a new connection for a region, can be replaced for testing
+        self.connect = connect
+        self.lock = threading.Lock()
+        self.connections = {}
+        #Number of times we've connected to each region, should never be more than 1
+        self.connect_count = {}
+        if metrics is None:
+            metrics = CallMetrics()
+        self.metrics = metrics
+        self.read_rate = read_rate
+        self.write_rate = write_rate
+        self.max_retries = max_retries
+
+    def get(self, region):
+        """
+        Returns the shared connection for a region, connecting the first time it's asked for
+        """
+        with self.lock:
+            if region not in self.connections:
+                self.logger.debug("Connecting to cloudformation in %s" % region)
+                self.connections[region] = PooledConnection(
+                    self.connect(region),
+                    self.size,
+                    metrics = self.metrics,
+                    read_bucket = TokenBucket(self.read_rate) if self.read_rate else None,
+                    write_bucket = TokenBucket(self.write_rate) if self.write_rate else None,
+                    max_retries = self.max_retries
+                )
+                self.connect_count[region] = self.connect_count.get(region, 0) + 1
+            return self.connections[region]
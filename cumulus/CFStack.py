@@ -1,10 +1,21 @@
+import hashlib
 import logging
 import simplejson
-from boto import cloudformation
+from CFConnectionPool import CFConnectionPool
+from ResolutionCache import ResolutionCache
+from StackIndex import StackIndex
+from TemplateDiff import TemplateDiff
+
+
+#Tag cumulus stamps on every stack with a hash of the template and parameters it was last created/updated with
+FINGERPRINT_TAG = 'cumulus-fingerprint'
+#Cloudformation limits on template size in bytes, when passed inline and when passed by S3 URL
+TEMPLATE_BODY_LIMIT = 51200
+TEMPLATE_URL_LIMIT = 1048576
 
 
 class CFStack:
-    def __init__(self, mega_stack_name, name, params, template_name, region, sns_topic_arn, tags = {}, depends_on = None):
+    def __init__(self, mega_stack_name, name, params, template_name, region, sns_topic_arn, tags = {}, depends_on = None, cf_pool = None, resolution_cache = None, template_store = None, fingerprint_cache = None):
         self.logger = logging.getLogger(__name__)
         if mega_stack_name == name:
             self.cf_stack_name = name
@@ -16,6 +27,14 @@ class CFStack:
         self.params = {}
         self.template_name = template_name
         self.template_body = ''
+        self.template = None
+        #Template currently in cloudformation, only fetched if we need it
+        self.cf_template = None
+        #If we have a TemplateStore, templates are uploaded to S3 and passed to CF by URL
+        self.template_store = template_store
+        self.template_url = None
+        #Optional FingerprintCache, for stacks in sync with cloudformation that don't have the fingerprint tag
+        self.fingerprint_cache = fingerprint_cache
         if depends_on is None:
             self.depends_on = None
         else:
@@ -38,28 +57,90 @@ class CFStack:
             self.logger.critical("Parameters for stack %s must be of type dict not %s" % (self.name, type(self.yaml_params)))
             exit(1)
 
-        self.cf_stacks = {}
-        self.cf_stacks_resources = {}
+        #Shared pool of cloudformation connections, normally owned by the MegaStack
+        if cf_pool is None:
+            cf_pool = CFConnectionPool()
+        self.cf_pool = cf_pool
+        #Values from other stacks used to populate params, shared across the MegaStack
+        if resolution_cache is None:
+            resolution_cache = ResolutionCache(self.cf_pool, self.region)
+        self.resolution_cache = resolution_cache
+
+    def cfconn(self):
+        """
+        Returns the cloudformation connection for this stack's region from the connection pool
+        """
+        return self.cf_pool.get(self.region)
     
+    def find_in_cf(self, current_cf_stacks, stack_name):
+        """
+        Look up a stack by name in current_cf_stacks, which can be a StackIndex or a plain list of stacks
+        from describe_stacks. Returns the stack object or None if it isn't there.
+        """
+        if isinstance(current_cf_stacks, StackIndex):
+            return current_cf_stacks.get(stack_name)
+        for stack in current_cf_stacks:
+            if str(stack.stack_name) == stack_name:
+                return stack
+        return None
+
     def deps_met(self, current_cf_stacks):
         if self.depends_on is None:
             return True
         else:
             for dep in self.depends_on:
-                dep_met = False
                 #check CF if stack we depend on has been created successfully
-                for stack in current_cf_stacks:
-                    if str(stack.stack_name) == dep:
-                        dep_met = True
-                if not dep_met:
+                if self.find_in_cf(current_cf_stacks, dep) is None:
                     return False
             return True
     
     def exists_in_cf(self, current_cf_stacks):
-        for stack in current_cf_stacks:
-            if str(stack.stack_name) == self.cf_stack_name:
-                return stack
-        return False
+        stack = self.find_in_cf(current_cf_stacks, self.cf_stack_name)
+        if stack is None:
+            return False
+        return stack
+
+    def source_stack_name(self, source):
+        """
+        Turn the source of a parameter in the yaml file into the name of the stack in cloudformation.
+        Sources starting with - are stacks outside this mega stack, so are used without the prefix.
+        """
+        if source == self.mega_stack_name:
+            return source
+        elif source[:1] == '-':
+            return source[1:]
+        else:
+            return "%s-%s" % (self.mega_stack_name, source)
+
+    def param_refs(self):
+        """
+        List of (source stack, var_type) for every value this stack needs to get from cloudformation,
+        from both single and list params
+        """
+        refs = []
+        for value in (self.yaml_params or {}).values():
+            items = value if type(value) is list else [value]
+            for item in items:
+                if type(item) is dict and not item.has_key('value') and self.is_cf_ref(item):
+                    refs.append((self.source_stack_name(item['source']), item['type']))
+        return refs
+
+    def is_cf_ref(self, item):
+        return item.has_key('source') and item.has_key('type') and item.has_key('variable')
+
+    def resolve_param_item(self, item):
+        """
+        Get the value for a single parameter item from the yaml file
+        """
+        #Static value set, so use it
+        if item.has_key('value'):
+            return str(item['value'])
+        #No static value set, but if we have a source, type and variable can try getting from CF
+        return self.get_value_from_cf(
+                source_stack = self.source_stack_name(item['source']),
+                var_type = item['type'],
+                var_name = item['variable']
+                )
 
     def populate_params(self, current_cf_stacks):
         #If we have no parameters in the yaml file, set params to an empty dict and return true
@@ -67,94 +148,33 @@ class CFStack:
             self.params = {}
             return True
         if self.deps_met(current_cf_stacks):
-            cfconn = cloudformation.connect_to_region(self.region)
             for param in self.yaml_params.keys():
                 if type(self.yaml_params[param]) is dict:
-                    #Static value set, so use it
-                    if self.yaml_params[param].has_key('value'):
-                        self.params[param] = str(self.yaml_params[param]['value'])
-                    #No static value set, but if we have a source, type and variable can try getting from CF
-                    elif self.yaml_params[param].has_key('source') and self.yaml_params[param].has_key('type') and self.yaml_params[param].has_key('variable'):
-                        if self.yaml_params[param]['source'] == self.mega_stack_name:
-                            source_stack = self.yaml_params[param]['source']
-                        elif self.yaml_params[param]['source'][:1] == '-':
-                            source_stack = self.yaml_params[param]['source'][1:]
-                        else:
-                            source_stack = "%s-%s" % (self.mega_stack_name, self.yaml_params[param]['source'])
-                        self.params[param] = self.get_value_from_cf(
-                                source_stack = source_stack,
-                                var_type = self.yaml_params[param]['type'],
-                                var_name = self.yaml_params[param]['variable']
-                                )
+                    if self.yaml_params[param].has_key('value') or self.is_cf_ref(self.yaml_params[param]):
+                        self.params[param] = self.resolve_param_item(self.yaml_params[param])
                 #If self.yaml_params[param] is a list it means there is an array of vars we need to turn into a comma sep list.
                 elif type(self.yaml_params[param]) is list:
                     param_list = []
                     for item in self.yaml_params[param]:
                         if type(item) is dict:
-                            #Static value set, so use it
-                            if item.has_key('value'):
-                                param_list.append(str(item['value']))
-                            #No static value set, but if we have a source, type and variable can try getting from CF
-                            elif item.has_key('source') and item.has_key('type') and item.has_key('variable'):
-                                if item['source'] == self.mega_stack_name:
-                                    source_stack = item['source']
-                                else:
-                                    source_stack = "%s-%s" % (self.mega_stack_name, item['source'])
-                                param_list.append(self.get_value_from_cf(
-                                    source_stack = source_stack,
-                                    var_type = item['type'],
-                                    var_name = item['variable']
-                                    ))
-                            else:
+                            if not (item.has_key('value') or self.is_cf_ref(item)):
                                 print "Error in yaml file, %s in parameter list for %s stack. Can't populate." % (self.yaml_params[param],self.name)
                                 exit(1)
+                            param_list.append(self.resolve_param_item(item))
                     self.params[param] = ','.join(param_list)
             return True
         else:
             return False
 
-    def get_cf_stack(self, stack, resources = False):
-        """
-        Get information on parameters, outputs and resources from a stack and cache it
-        """
-        if not resources: 
-            if not self.cf_stacks.has_key(stack):
-                #We don't have this stack in the cache already so we need to pull it from CF
-                cfconn = cloudformation.connect_to_region(self.region)
-                self.cf_stacks[stack] = cfconn.describe_stacks(stack)[0]
-            return self.cf_stacks[stack]
-        else:
-            if not self.cf_stacks_resources.has_key(stack):
-                cfconn = cloudformation.connect_to_region(self.region)
-                the_stack = self.get_cf_stack(stack = stack, resources = False)
-                self.cf_stacks_resources[stack] = the_stack.list_resources()
-            return self.cf_stacks_resources[stack]
-
     def get_value_from_cf(self, source_stack, var_type, var_name):
         """
         Get a variable from a existing cloudformation stack, var_type should be parameter, resource or output.
         If using resource, provide the logical ID and this will return the Physical ID
         """
-        cfconn = cloudformation.connect_to_region(self.region)
-
-        the_stack = self.get_cf_stack(stack = source_stack)
-        if var_type == 'parameter':
-            for p in the_stack.parameters:
-                if str(p.key) == var_name:
-                    return str(p.value)
-        elif var_type == 'output':
-            for o in the_stack.outputs:
-                if str(o.key) == var_name:
-                    return str(o.value)
-        elif var_type == 'resource':
-            for r in self.get_cf_stack(stack = source_stack, resources = True):
-                if str(r.logical_resource_id) == var_name:
-                    return str(r.physical_resource_id)
-        else:
+        if var_type not in ResolutionCache.TYPES:
             print "Error: invalid var_type passed to get_value_from_cf, needs to be parameter, resource or output. Not: %s" % (var_type)
             exit(1)
-
-            
+        return self.resolution_cache.lookup(source_stack, var_type, var_name)
 
     def get_params_tuples(self):
         tuple_list = []
@@ -164,26 +184,136 @@ class CFStack:
         return tuple_list
 
     def read_template(self):
+        """
+        Read and parse the template file, only the first time it's called. The parsed template is kept
+        in self.template and self.template_body is its compact encoding with sorted keys, so the same
+        template always produces the same body.
+        """
+        if self.template is not None:
+            return True
         try:
             template_file = open(self.template_name, 'r')
             template = simplejson.load(template_file)
         except Exception as e:
             print "Cannot open template file for stack %s, error: %s" % (self.name, e)
             exit(1)
-        self.template_body = simplejson.dumps(template)
+        self.template = template
+        self.template_body = simplejson.dumps(template, sort_keys=True, separators=(',', ':'))
         return True
 
-    
+    def template_hash(self):
+        """
+        SHA-256 of the template as it's sent to cloudformation, so formatting changes to the file don't count as changes.
+        Used wherever a run needs to tell if a template has changed since it was recorded.
+        """
+        self.read_template()
+        return hashlib.sha256(self.template_body).hexdigest()
+
+    def template_size_limit(self):
+        """
+        The largest template cloudformation will accept for this stack, depending on whether it's passed by URL
+        """
+        if self.template_store is not None:
+            return TEMPLATE_URL_LIMIT
+        return TEMPLATE_BODY_LIMIT
+
+    def template_size_ok(self):
+        """
+        Returns False if the template is too big for cloudformation to accept. Needs read_template to have been run.
+        """
+        if len(self.template_body) > self.template_size_limit():
+            self.logger.critical("Template for stack %s is %s bytes, over the cloudformation limit of %s bytes" % (self.name, len(self.template_body), self.template_size_limit()))
+            return False
+        return True
+
+    def template_args(self):
+        """
+        Arguments for passing the template to create_stack, update_stack or validate_template.
+        Uses the S3 URL if there is a template store, uploading the template the first time, otherwise the template body.
+        Only called when the stack is about to be changed, so read only actions never write to the bucket.
+        """
+        if self.template_store is not None and self.template_url is None:
+            self.template_url = self.template_store.store(self.template_body)
+        if self.template_url:
+            return {'template_url': self.template_url}
+        return {'template_body': self.template_body}
+
+    def get_cf_template(self):
+        """
+        Fetch and parse the template of this stack currently in cloudformation. Kept until clear_cf_template is called.
+        """
+        if self.cf_template is None:
+            response = self.cfconn().get_template(self.cf_stack_name)
+            self.cf_template = simplejson.loads(response['GetTemplateResponse']['GetTemplateResult']['TemplateBody'])
+        return self.cf_template
+
+    def clear_cf_template(self):
+        self.cf_template = None
+
+    def fingerprint(self):
+        """
+        Hash of the template and resolved parameters. Needs read_template and populate_params to have been run.
+        """
+        params = simplejson.dumps(sorted(self.params.items()), separators=(',', ':'))
+        return hashlib.sha256(self.template_body + "\n" + params).hexdigest()
+
+    def stack_tags(self):
+        """
+        Tags to send to cloudformation, the tags from the yaml file plus the fingerprint tag
+        """
+        tags = dict(self.tags)
+        tags[FINGERPRINT_TAG] = self.fingerprint()
+        return tags
+
+    def cf_fingerprint(self, current_cf_stacks):
+        """
+        The fingerprint of the stack in cloudformation, or None if it doesn't have one. That's the one it's tagged with,
+        or if it isn't tagged the one in the fingerprint cache, if it was recorded since the stack last changed.
+        """
+        cf_stack = self.exists_in_cf(current_cf_stacks)
+        if not cf_stack:
+            return None
+        tagged = self.fingerprint_tag(cf_stack)
+        if tagged is not None or self.fingerprint_cache is None:
+            return tagged
+        return self.fingerprint_cache.get(self.cf_stack_name, cf_stack)
+
+    def fingerprint_tag(self, cf_stack):
+        tags = cf_stack.tags or {}
+        if not isinstance(tags, dict):
+            tags = dict([(str(tag.key), str(tag.value)) for tag in tags])
+        return tags.get(FINGERPRINT_TAG)
+
+    def record_fingerprint(self, current_cf_stacks):
+        """
+        Remember our fingerprint for a stack that has been found in sync with cloudformation but isn't tagged
+        with it, so the next run doesn't have to fetch its template to find that out again
+        """
+        cf_stack = self.exists_in_cf(current_cf_stacks)
+        if not cf_stack or self.fingerprint_cache is None or self.fingerprint_tag(cf_stack) is not None:
+            return
+        self.fingerprint_cache.record(self.cf_stack_name, cf_stack, self.fingerprint())
+
+    def forget_fingerprint(self):
+        """
+        Drop the stack from the fingerprint cache, when it's about to be changed in cloudformation
+        """
+        if self.fingerprint_cache is not None:
+            self.fingerprint_cache.forget(self.cf_stack_name)
+
     def template_uptodate(self, current_cf_stacks):
         """
         Check if stack is up to date with cloudformation.
         Returns true if template matches whats in cloudformation, false if not or stack not found.
+        If the fingerprint on the stack matches ours the template hasn't changed, so we don't need to download it.
         """
         cf_stack = self.exists_in_cf(current_cf_stacks)
         if not cf_stack:
             return False
-        cf_template_dict = simplejson.loads(cf_stack.get_template()['GetTemplateResponse']['GetTemplateResult']['TemplateBody'])
-        if cf_template_dict == simplejson.loads(self.template_body):
+        if self.cf_fingerprint(current_cf_stacks) == self.fingerprint():
+            self.logger.debug("Fingerprint of stack %s matches, not fetching template" % self.name)
+            return True
+        if self.get_cf_template() == self.template:
             return True
         else:
             return False
@@ -215,9 +345,16 @@ class CFStack:
         #We got to the end without returning False, so must be fine.
         return True
 
-    def print_template_diff(self, current_cf_stacks):
+    def template_diff(self, current_cf_stacks, include_template = True):
+        """
+        Structural diff of what's in cloudformation against our template and parameters.
+        The template is only fetched from cloudformation if include_template is set.
+        Returns None if the stack isn't in cloudformation.
+        """
         cf_stack = self.exists_in_cf(current_cf_stacks)
-        cf_template_dict = simplejson.loads(cf_stack.get_template()['GetTemplateResponse']['GetTemplateResult']['TemplateBody'])
-
-        self.logger.info(datadiff.diff(cf_template_dict, simplejson.loads(self.template_body), context=0))
-        
+        if not cf_stack:
+            return None
+        cf_params = dict([(str(param.key), str(param.value)) for param in cf_stack.parameters])
+        if include_template:
+            return TemplateDiff(self.get_cf_template(), self.template, cf_params, self.params)
+        return TemplateDiff(None, None, cf_params, self.params)
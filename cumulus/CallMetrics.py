@@ -0,0 +1,201 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+#The stack the current thread is working on, set with stack_context
+_context = threading.local()
+
+
+@contextmanager
+def stack_context(stack_name):
+    """
+    Tag cloudformation calls made by this thread, inside the with block, as made on behalf of stack_name
+    """
+    previous = getattr(_context, 'stack', None)
+    _context.stack = stack_name
+    try:
+        yield
+    finally:
+        _context.stack = previous
+
+
+def current_stack():
+    return getattr(_context, 'stack', None)
+
+
+def payload_size(value):
+    """
+    Rough size in bytes of the strings in an API call's arguments or response
+    """
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum([payload_size(k) + payload_size(v) for k, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        return sum([payload_size(v) for v in value])
+    return 0
+
+
+class CallMetrics:
+    """
+    Counts and times every cloudformation API call made through a CFConnectionPool.
+    Each call is tagged with the API operation and the stack it was made for: the stack set with
+    stack_context if there is one, otherwise the stack the call is about, or - for region wide calls.
+    Keeps call, error, throttle and retry counts and request and response sizes per operation and stack,
+    and a latency histogram per operation. Response sizes are only known for calls that return a
+    document, like get_template, other calls count the number of items returned instead.
+    """
+    #Upper bounds of the latency histogram buckets in seconds
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #Counters keyed by (operation, stack)
+        self.counters = {}
+        #Every call duration, keyed by operation
+        self.durations = {}
+        #Errors keyed by (operation, stack, error code)
+        self.errors = {}
+
+    def _counter(self, operation, stack):
+        key = (operation, stack or '-')
+        if key not in self.counters:
+            self.counters[key] = {'calls': 0, 'errors': 0, 'throttled': 0, 'retries': 0, 'seconds': 0.0,
+                                  'request_bytes': 0, 'response_bytes': 0, 'response_items': 0}
+        return self.counters[key]
+
+    def record(self, operation, stack, seconds, request_bytes = 0, response_bytes = 0, response_items = 0, error_code = None, throttled = False):
+        with self.lock:
+            counter = self._counter(operation, stack)
+            counter['calls'] += 1
+            counter['seconds'] += seconds
+            counter['request_bytes'] += request_bytes
+            counter['response_bytes'] += response_bytes
+            counter['response_items'] += response_items
+            if error_code:
+                counter['errors'] += 1
+                if throttled:
+                    counter['throttled'] += 1
+                key = (operation, stack or '-', error_code)
+                self.errors[key] = self.errors.get(key, 0) + 1
+            self.durations.setdefault(operation, []).append(seconds)
+
+    def record_retry(self, operation, stack):
+        with self.lock:
+            self._counter(operation, stack)['retries'] += 1
+
+    def by_operation(self):
+        """
+        Counters summed over stacks, keyed by operation
+        """
+        totals = {}
+        with self.lock:
+            for (operation, stack), counter in self.counters.items():
+                total = totals.setdefault(operation, dict([(name, 0) for name in counter]))
+                for name, value in counter.items():
+                    total[name] += value
+        return totals
+
+    def by_stack(self):
+        """
+        Counters summed over operations, keyed by stack
+        """
+        totals = {}
+        with self.lock:
+            for (operation, stack), counter in self.counters.items():
+                total = totals.setdefault(stack, dict([(name, 0) for name in counter]))
+                for name, value in counter.items():
+                    total[name] += value
+        return totals
+
+    def percentile(self, operation, fraction):
+        durations = sorted(self.durations.get(operation, []))
+        if not durations:
+            return 0.0
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))]
+
+    def histogram(self, operation):
+        """
+        Cumulative counts of calls at or under each bucket, as (upper bound, count), ending with +Inf
+        """
+        durations = self.durations.get(operation, [])
+        buckets = [(bound, len([d for d in durations if d <= bound])) for bound in self.BUCKETS]
+        buckets.append(('+Inf', len(durations)))
+        return buckets
+
+    def summary_lines(self, top_stacks = 10):
+        """
+        Table of calls and latency per operation, followed by the stacks making the most calls
+        """
+        operations = self.by_operation()
+        if not operations:
+            return ["No cloudformation API calls made"]
+        lines = ["%-24s %6s %6s %6s %7s %9s %8s %8s %8s %10s" % ("operation", "calls", "errors", "thrott", "retries", "total s", "p50 s", "p95 s", "max s", "bytes")]
+        for operation in sorted(operations, key=lambda op: -operations[op]['calls']):
+            counter = operations[operation]
+            lines.append("%-24s %6s %6s %6s %7s %9.3f %8.3f %8.3f %8.3f %10s" % (
+                operation, counter['calls'], counter['errors'], counter['throttled'], counter['retries'], counter['seconds'],
+                self.percentile(operation, 0.5), self.percentile(operation, 0.95), self.percentile(operation, 1),
+                counter['request_bytes'] + counter['response_bytes']))
+        stacks = self.by_stack()
+        lines.append("%-40s %6s %6s %6s %9s" % ("stack", "calls", "errors", "thrott", "total s"))
+        for stack in sorted(stacks, key=lambda name: -stacks[name]['calls'])[:top_stacks]:
+            counter = stacks[stack]
+            lines.append("%-40s %6s %6s %6s %9.3f" % (stack, counter['calls'], counter['errors'], counter['throttled'], counter['seconds']))
+        return lines
+
+    def as_dict(self):
+        with self.lock:
+            calls = [dict(counter, operation=operation, stack=stack) for (operation, stack), counter in sorted(self.counters.items())]
+            errors = [{'operation': operation, 'stack': stack, 'code': code, 'count': count} for (operation, stack, code), count in sorted(self.errors.items())]
+        latency = {}
+        for operation in sorted(self.durations):
+            latency[operation] = {
+                'p50': self.percentile(operation, 0.5),
+                'p95': self.percentile(operation, 0.95),
+                'max': self.percentile(operation, 1),
+                'histogram': [[str(bound), count] for bound, count in self.histogram(operation)],
+            }
+        return {'calls': calls, 'errors': errors, 'latency': latency}
+
+    def prometheus_lines(self):
+        """
+        The metrics in the Prometheus text format, for the node exporter textfile collector
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            errors = sorted(self.errors.items())
+        for name, field, help_text in (
+                ('calls', 'calls', 'Cloudformation API calls made by cumulus'),
+                ('retries', 'retries', 'Cloudformation API calls retried'),
+                ('request_bytes', 'request_bytes', 'Size of the strings sent in cloudformation API calls'),
+                ('response_bytes', 'response_bytes', 'Size of the documents returned by cloudformation API calls')):
+            lines.append("# HELP cumulus_cf_api_%s_total %s" % (name, help_text))
+            lines.append("# TYPE cumulus_cf_api_%s_total counter" % name)
+            for (operation, stack), counter in counters:
+                lines.append('cumulus_cf_api_%s_total{operation="%s",stack="%s"} %s' % (name, operation, stack, counter[field]))
+        lines.append("# HELP cumulus_cf_api_errors_total Cloudformation API calls that returned an error")
+        lines.append("# TYPE cumulus_cf_api_errors_total counter")
+        for (operation, stack, code), count in errors:
+            lines.append('cumulus_cf_api_errors_total{operation="%s",stack="%s",code="%s"} %s' % (operation, stack, code, count))
+        lines.append("# HELP cumulus_cf_api_call_duration_seconds Latency of cloudformation API calls")
+        lines.append("# TYPE cumulus_cf_api_call_duration_seconds histogram")
+        for operation in sorted(self.durations):
+            for bound, count in self.histogram(operation):
+                lines.append('cumulus_cf_api_call_duration_seconds_bucket{operation="%s",le="%s"} %s' % (operation, bound, count))
+            lines.append('cumulus_cf_api_call_duration_seconds_sum{operation="%s"} %s' % (operation, sum(self.durations[operation])))
+            lines.append('cumulus_cf_api_call_duration_seconds_count{operation="%s"} %s' % (operation, len(self.durations[operation])))
+        return lines
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics to a Prometheus textfile. Writes to a temporary file and renames it,
+        so the collector never reads a half written file.
+        """
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        prom_file = open(tmp_path, 'w')
+        prom_file.write("\n".join(self.prometheus_lines()) + "\n")
+        prom_file.close()
+        os.rename(tmp_path, path)
@@ -0,0 +1,181 @@
+class DependencyError(Exception):
+    """
+    Raised when the stacks can't be put in dependency order, because of a circular dependency
+    or a dependency on a stack that isn't in the yaml file
+    """
+    pass
+
+
+class DepGraph:
+    """
+    Dependency graph of a set of CFStack objects, keyed by cf_stack_name.
+    Works out the order stacks have to be processed in and which stacks can be processed
+    at the same time (waves), in time linear to the number of stacks and dependencies.
+    """
+    def __init__(self, stacks):
+        self.stacks = dict([(stack.cf_stack_name, stack) for stack in stacks])
+        #Position of each stack in the list we were given, so the order we return is stable
+        self.position = dict([(stack.cf_stack_name, i) for i, stack in enumerate(stacks)])
+        #depends[name] are the stacks name needs, dependents[name] are the stacks that need name
+        self.depends = dict([(name, []) for name in self.stacks])
+        self.dependents = dict([(name, []) for name in self.stacks])
+        #Dependencies on stacks we don't know about, kept separately so they don't block sorting
+        self.missing = {}
+        for stack in stacks:
+            seen = set()
+            for dep in stack.depends_on or []:
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                if dep not in self.stacks:
+                    self.missing.setdefault(stack.cf_stack_name, []).append(dep)
+                    continue
+                self.depends[stack.cf_stack_name].append(dep)
+                self.dependents[dep].append(stack.cf_stack_name)
+        self.order = None
+        self.waves = None
+
+    def sort(self):
+        """
+        Topologically sort the stacks using Kahn's algorithm. Sets self.order to a flat list of stack
+        names and self.waves to a list of lists of names, where every stack in a wave only depends on
+        stacks in earlier waves. Raises DependencyError with details of any missing dependency or cycle.
+        """
+        if self.missing:
+            problems = []
+            for name in sorted(self.missing, key=self.position.get):
+                for dep in self.missing[name]:
+                    problems.append("%s depends on %s" % (name, dep))
+            raise DependencyError("Dependency on stack not in yaml file (or disabled): %s" % ", ".join(problems))
+
+        order, waves = self._waves()
+        if len(order) != len(self.stacks):
+            remaining = set(self.stacks) - set(order)
+            raise DependencyError("Circular dependency: %s" % " -> ".join(self.find_cycle(remaining)))
+        self.order = order
+        self.waves = waves
+        return order
+
+    def _waves(self):
+        """
+        Kahn's algorithm over the dependencies in the graph, returns (order, waves). Stacks in cycles are left out.
+        """
+        indegree = dict([(name, len(deps)) for name, deps in self.depends.items()])
+        wave = sorted([name for name in indegree if indegree[name] == 0], key=self.position.get)
+        order = []
+        waves = []
+        while wave:
+            waves.append(wave)
+            order.extend(wave)
+            next_wave = []
+            for name in wave:
+                for dependent in self.dependents[name]:
+                    indegree[dependent] -= 1
+                    if indegree[dependent] == 0:
+                        next_wave.append(dependent)
+            wave = sorted(next_wave, key=self.position.get)
+        return order, waves
+
+    def redundant_deps(self):
+        """
+        Dependencies that are implied by a stack's other dependencies, so leaving them out doesn't change
+        when any stack can start. Returns lists of (dependency, the other dependency it is reached through)
+        keyed by stack name. Returns nothing if there is a cycle.
+        """
+        order, waves = self._waves()
+        if len(order) != len(self.stacks):
+            return {}
+        #Every stack each stack depends on, directly or through other stacks
+        reach = {}
+        redundant = {}
+        for name in order:
+            reach[name] = set(self.depends[name])
+            for dep in self.depends[name]:
+                reach[name].update(reach[dep])
+            for dep in self.depends[name]:
+                for other in self.depends[name]:
+                    if other != dep and dep in reach[other]:
+                        redundant.setdefault(name, []).append((dep, other))
+                        break
+        return redundant
+
+    def reduce(self):
+        """
+        Remove the redundant dependencies, leaving the transitive reduction of the graph, so each stack only
+        waits on the stacks nothing else it waits on already waits for. Returns the number removed.
+        """
+        removed = 0
+        for name, redundant in self.redundant_deps().items():
+            for dep, other in redundant:
+                self.depends[name].remove(dep)
+                self.dependents[dep].remove(name)
+                removed += 1
+        if removed:
+            self.order = None
+            self.waves = None
+        return removed
+
+    def critical_paths(self, durations, reverse = False):
+        """
+        For each stack, the longest total duration of a chain of stacks starting with it and following
+        its dependents (its dependencies if reverse is set), so the least time the run can take once it
+        starts. durations is keyed by stack name, stacks without one count as 0. Stacks in cycles are left out.
+        """
+        after = self.depends if reverse else self.dependents
+        before = self.dependents if reverse else self.depends
+        #Work backwards from the stacks nothing has to wait for
+        remaining = dict([(name, len(after[name])) for name in self.stacks])
+        ready = [name for name in remaining if remaining[name] == 0]
+        paths = {}
+        while ready:
+            name = ready.pop()
+            paths[name] = durations.get(name, 0) + max([paths[following] for following in after[name]] or [0])
+            for previous in before[name]:
+                remaining[previous] -= 1
+                if remaining[previous] == 0:
+                    ready.append(previous)
+        return paths
+
+    def downstream(self, names):
+        """
+        Set of the given stack names and every stack that depends on them, directly or through other stacks
+        """
+        found = set(names)
+        pending = list(names)
+        while pending:
+            for dependent in self.dependents.get(pending.pop(), []):
+                if dependent not in found:
+                    found.add(dependent)
+                    pending.append(dependent)
+        return found
+
+    def find_cycle(self, remaining):
+        """
+        Find a cycle among the stacks left over after sorting. Every one of them still depends on
+        another left over stack, so following dependencies from any of them must loop back.
+        """
+        start = min(remaining, key=self.position.get)
+        path = []
+        index = {}
+        name = start
+        while name not in index:
+            index[name] = len(path)
+            path.append(name)
+            name = [dep for dep in self.depends[name] if dep in remaining][0]
+        return path[index[name]:] + [name]
+
+    def sorted_stacks(self):
+        """
+        List of stack objects in dependency order
+        """
+        if self.order is None:
+            self.sort()
+        return [self.stacks[name] for name in self.order]
+
+    def stack_waves(self):
+        """
+        List of lists of stack objects that can be processed at the same time, in dependency order
+        """
+        if self.waves is None:
+            self.sort()
+        return [[self.stacks[name] for name in wave] for wave in self.waves]
@@ -0,0 +1,30 @@
+from JsonStore import JsonStore
+
+
+class DurationHistory(JsonStore):
+    """
+    How long each stack's creates, updates and deletes have taken, kept in a small JSON file between runs.
+    Only the last few durations of each stack and operation are kept, estimates are their median.
+    Durations are lists of seconds in self.data, keyed by cf_stack_name then operation.
+    """
+    KEEP = 5
+
+    def __init__(self, path):
+        JsonStore.__init__(self, path, "duration history")
+
+    def record(self, stack_name, operation, seconds):
+        with self.lock:
+            recent = self.data.setdefault(stack_name, {}).setdefault(operation, [])
+            recent.append(round(seconds, 1))
+            del recent[:-self.KEEP]
+            self.changed = True
+
+    def estimate(self, stack_name, operation):
+        """
+        Expected seconds for an operation on a stack, or None if it's never been recorded
+        """
+        with self.lock:
+            recent = sorted(self.data.get(stack_name, {}).get(operation, []))
+        if not recent:
+            return None
+        return recent[len(recent) / 2]
@@ -0,0 +1,130 @@
+import boto
+import logging
+import random
+import time
+from CFConnectionPool import paginate
+
+
+class EventTailer:
+    """
+    Follows the events of a single cloudformation stack.
+    Remembers the ID of the last event it has seen so each poll only pages through describe_stack_events
+    until it reaches events it already has. The stack status is taken from the stack's own events, so
+    the stack doesn't need to be described on every poll.
+    Polls quickly to start with, then backs off exponentially (with jitter) while nothing is happening.
+    The timestamps of the stack events starting and finishing the latest operation are kept, so
+    duration gives how long cloudformation took over it.
+    """
+    def __init__(self, cfconn, stack_name, min_interval = 2, max_interval = 30):
+        self.logger = logging.getLogger(__name__)
+        self.cfconn = cfconn
+        self.stack_name = stack_name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.last_event_id = None
+        #Current status of the stack, STACK_GONE once cloudformation says it doesn't exist
+        self.status = None
+        self.started_at = None
+        self.finished_at = None
+
+    def stack_gone(self, e):
+        if "Stack:%s does not exist" % self.stack_name in str(e.error_message):
+            self.status = "STACK_GONE"
+            return True
+        return False
+
+    def start(self):
+        """
+        Get the current status of the stack and its most recent events.
+        Returns the last 5 events, oldest first.
+        """
+        try:
+            self.status = str(self.cfconn.describe_stacks(self.stack_name)[0].stack_status)
+            events = list(self.cfconn.describe_stack_events(self.stack_name))
+        except boto.exception.BotoServerError as e:
+            if self.stack_gone(e):
+                return []
+            raise
+        for event in reversed(events):
+            self.track(event)
+        if events:
+            self.last_event_id = events[0].event_id
+        self.interval = self.min_interval
+        return list(reversed(events[:5]))
+
+    def track(self, event):
+        """
+        Note the start or end of an operation from an event. Returns True if it was an event of the stack itself.
+        """
+        if str(event.resource_type) != "AWS::CloudFormation::Stack" or str(event.logical_resource_id) != self.stack_name:
+            return False
+        status = str(event.resource_status)
+        if not status.endswith("_IN_PROGRESS"):
+            self.finished_at = event.timestamp
+        elif not status.endswith("CLEANUP_IN_PROGRESS"):
+            self.started_at = event.timestamp
+            self.finished_at = None
+        return True
+
+    def duration(self):
+        """
+        Seconds the latest operation on the stack took, according to its events. None if we haven't seen it start and finish.
+        """
+        if self.started_at is None or self.finished_at is None or self.finished_at < self.started_at:
+            return None
+        elapsed = self.finished_at - self.started_at
+        return elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1000000.0
+
+    def fetch_new_events(self):
+        """
+        Page through events, newest first, until we get to the last one we've seen, or just the first page
+        if we haven't seen any yet. Returns the new events oldest first.
+        """
+        new_events = []
+        for event in paginate(self.cfconn.describe_stack_events, self.stack_name, max_pages = 1 if self.last_event_id is None else None):
+            if event.event_id == self.last_event_id:
+                break
+            new_events.append(event)
+        new_events.reverse()
+        return new_events
+
+    def poll(self):
+        """
+        Get any events since the last poll, oldest first, and update the stack status.
+        Resets the polling interval if there were new events, otherwise backs off.
+        """
+        try:
+            new_events = self.fetch_new_events()
+        except boto.exception.BotoServerError as e:
+            if self.stack_gone(e):
+                return []
+            raise
+        if new_events:
+            self.last_event_id = new_events[-1].event_id
+            for event in new_events:
+                if self.track(event):
+                    self.status = str(event.resource_status)
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+            if self.interval == self.max_interval:
+                #Been quiet for a while, double check the status in case we missed the stack event
+                try:
+                    self.status = str(self.cfconn.describe_stacks(self.stack_name)[0].stack_status)
+                except boto.exception.BotoServerError as e:
+                    if not self.stack_gone(e):
+                        raise
+        return new_events
+
+    def next_delay(self):
+        """
+        Seconds until the next poll is due. Jitter spreads out polls when many stacks are being watched.
+        """
+        return random.uniform(self.interval / 2.0, self.interval)
+
+    def wait(self):
+        """
+        Sleep until the next poll is due
+        """
+        time.sleep(self.next_delay())
@@ -0,0 +1,43 @@
+from JsonStore import JsonStore
+from StackIndex import last_updated_time
+
+
+class FingerprintCache(JsonStore):
+    """
+    Fingerprints of stacks found to be in sync with cloudformation that don't have the fingerprint tag,
+    because they were created or last updated without cumulus stamping them, kept in a small JSON file
+    between runs. Each fingerprint is kept with the stack's id and the time it was last changed, so it's
+    only used while the stack in cloudformation is still the one that was checked, and only for stacks
+    that still aren't tagged. The fingerprint and stack version are in self.data, keyed by cf_stack_name.
+    """
+    def __init__(self, path):
+        JsonStore.__init__(self, path, "fingerprint cache")
+
+    def version(self, cf_stack):
+        """
+        Identifies the state of a stack in cloudformation, changes whenever the stack is updated or recreated
+        """
+        return "%s %s" % (getattr(cf_stack, 'stack_id', None), last_updated_time(cf_stack) or cf_stack.creation_time)
+
+    def get(self, stack_name, cf_stack):
+        """
+        The fingerprint recorded for the stack as it is now in cloudformation, or None
+        """
+        with self.lock:
+            entry = self.data.get(stack_name)
+        if entry is None or entry['version'] != self.version(cf_stack):
+            return None
+        return entry['fingerprint']
+
+    def record(self, stack_name, cf_stack, fingerprint):
+        entry = {'fingerprint': fingerprint, 'version': self.version(cf_stack)}
+        with self.lock:
+            if self.data.get(stack_name) != entry:
+                self.data[stack_name] = entry
+                self.changed = True
+
+    def forget(self, stack_name):
+        with self.lock:
+            if stack_name in self.data:
+                del self.data[stack_name]
+                self.changed = True
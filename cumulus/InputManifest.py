@@ -0,0 +1,54 @@
+import hashlib
+import simplejson
+from JsonStore import JsonStore
+from StackPlan import yaml_params_hash
+
+
+def input_hashes(stack):
+    """
+    Hashes of everything in the yaml file and on disk that goes into a stack: its template,
+    its params block, its tags and its SNS topics
+    """
+    return {
+        'template': stack.template_hash(),
+        'params': yaml_params_hash(stack),
+        'tags': hashlib.sha256(simplejson.dumps(stack.tags or {}, sort_keys=True)).hexdigest(),
+        'sns_topic_arn': hashlib.sha256(simplejson.dumps(sorted(stack.sns_topic_arn or []))).hexdigest(),
+    }
+
+
+class InputManifest(JsonStore):
+    """
+    Hashes of the inputs of each stack the last time it was known to be in sync with cloudformation,
+    kept in a small JSON file between runs. Used to tell which stacks could have changed without
+    asking cloudformation. The hashes are in self.data, keyed by cf_stack_name.
+    """
+    def __init__(self, path):
+        JsonStore.__init__(self, path, "manifest")
+
+    def changes(self, stack):
+        """
+        Names of the inputs of a stack that have changed since it was recorded, ['unrecorded'] if it never was
+        """
+        with self.lock:
+            recorded = self.data.get(stack.cf_stack_name)
+        if recorded is None:
+            return ['unrecorded']
+        current = input_hashes(stack)
+        return sorted([name for name in current if recorded.get(name) != current[name]])
+
+    def record(self, stack):
+        hashes = input_hashes(stack)
+        with self.lock:
+            self.data[stack.cf_stack_name] = hashes
+            self.changed = True
+
+    def forget(self, stack_names):
+        """
+        Drop stacks from the manifest, so they count as changed until they're recorded again
+        """
+        with self.lock:
+            for name in stack_names:
+                if name in self.data:
+                    del self.data[name]
+                    self.changed = True
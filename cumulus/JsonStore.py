@@ -0,0 +1,44 @@
+import logging
+import threading
+import simplejson
+
+
+class JsonStore:
+    """
+    A dict about the stacks of a mega stack, kept in a small JSON file between runs. Base class for the
+    duration history, input manifest and fingerprint cache. A missing file starts an empty store and an
+    unreadable one is ignored with a warning, as is a file that can't be written. Subclasses change self.data
+    while holding self.lock and set self.changed, save only writes the file if something did change.
+    """
+    def __init__(self, path, description):
+        self.logger = logging.getLogger(self.__class__.__module__)
+        self.path = path
+        #What the store is, for log messages
+        self.description = description
+        self.lock = threading.Lock()
+        self.changed = False
+        self.data = {}
+        try:
+            store_file = open(path, 'r')
+            self.data = simplejson.load(store_file)
+            store_file.close()
+        except IOError:
+            pass
+        except ValueError as e:
+            self.logger.warning("Ignoring unreadable %s %s: %s" % (description, path, e))
+
+    def save(self):
+        """
+        Write the store back to its file, if anything was changed
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            try:
+                store_file = open(self.path, 'w')
+                simplejson.dump(self.data, store_file, sort_keys=True, indent=2)
+                store_file.close()
+            except IOError as e:
+                self.logger.warning("Can't save %s %s: %s" % (self.description, self.path, e))
+                return
+            self.changed = False
@@ -1,16 +1,32 @@
 import boto
+import datetime
 import logging
+import os
 import simplejson
 import time
 import yaml
-from CFStack import CFStack
-from boto import cloudformation
+from CFConnectionPool import CFConnectionPool
+from CFStack import CFStack, TEMPLATE_BODY_LIMIT, TEMPLATE_URL_LIMIT
+from DepGraph import DepGraph, DependencyError
+from EventTailer import EventTailer
+from RegionSnapshot import RegionSnapshot, SnapshotError, load_snapshot
+from ResolutionCache import ResolutionCache
+from StackIndex import StackIndex
+from StackPlan import StackPlan, PlanError, load_plan, yaml_params_hash
+from StackScheduler import StackScheduler
+from StackWatcher import StackWatcher
+from TemplateStore import TemplateStore
+
+#Stack statuses cloudformation is still working on, and ones that the stack can't be created or updated from
+IN_PROGRESS_STATUSES = ["CREATE_IN_PROGRESS", "ROLLBACK_IN_PROGRESS", "DELETE_IN_PROGRESS", "UPDATE_IN_PROGRESS",
+                        "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS", "UPDATE_ROLLBACK_IN_PROGRESS", "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS"]
+BROKEN_STATUSES = ["CREATE_FAILED", "ROLLBACK_COMPLETE", "ROLLBACK_FAILED", "DELETE_FAILED", "UPDATE_ROLLBACK_FAILED"]
 
 class MegaStack:
     """
     Main workder class for cumulus. Holds array of CFstack objects and does most of the calls to cloudformation API
     """
-    def __init__(self, yamlFile):
+    def __init__(self, yamlFile, cf_pool = None, from_snapshot = None, duration_history = None, input_manifest = None, fingerprint_cache = None, s3conn = None):
         self.logger = logging.getLogger(__name__)
         
         #load the yaml file and turn it into a dict
@@ -40,19 +56,54 @@ class MegaStack:
                 exit(1)
 
         self.global_tags = self.stackDict[self.name].get('tags', {})
+
         #Array for holding CFStack objects once we create them
         self.stack_objs = []
+        #Dependency graph of stack_objs, set up by sort_stacks_by_deps
+        self.dep_graph = None
+        #Log the changes to each stack before updating it
+        self.show_diff = False
+        #Carry on with the stacks that don't depend on a failed stack, rather than stopping at the first failure
+        self.keep_going = False
+        #Optional RunJournal for the create or update being run, set by create and update
+        self.journal = None
+        #Optional DurationHistory, records how long operations take and is used to schedule and estimate runs
+        self.duration_history = duration_history
+        #Optional InputManifest, records the inputs of stacks once they're in sync with cloudformation
+        self.input_manifest = input_manifest
 
         #Get the names of the sub stacks from the yaml file and sort in array
         self.cf_stacks = self.stackDict[self.name]['stacks'].keys()
         
-        #Megastack holds the connection to cloudformation and list of stacks currently in our region
+        #If working from a RegionSnapshot, cf_pool should be connecting through it and nothing is sent to AWS
+        self.from_snapshot = from_snapshot
+        if from_snapshot is not None and (from_snapshot.mega_stack_name != self.name or from_snapshot.region != self.region):
+            self.logger.critical("Snapshot is of mega stack %s in %s, not %s in %s" % (from_snapshot.mega_stack_name, from_snapshot.region, self.name, self.region))
+            exit(1)
+
+        #Megastack holds the pool of connections to cloudformation and an index of stacks currently in our region
         #Stops us making lots of calls to cloudformation API for each stack
+        if cf_pool is None:
+            cf_pool = CFConnectionPool()
+        self.cf_pool = cf_pool
         try:
-            self.cfconn = cloudformation.connect_to_region(self.region)
-            self.cf_desc_stacks = self.cfconn.describe_stacks()
+            self.cfconn = self.cf_pool.get(self.region)
+            self.cf_desc_stacks = StackIndex()
+            self.cf_desc_stacks.refresh(self.cfconn)
+            #Parameters, outputs and resources of stacks that other stacks pull values from
+            self.resolution_cache = ResolutionCache(self.cf_pool, self.region, stack_index=self.cf_desc_stacks)
+            #Optional S3 bucket to upload templates to, so they are passed to cloudformation by URL
+            self.template_store = None
+            if self.stackDict[self.name].get('template-bucket'):
+                self.template_store = TemplateStore(
+                    bucket_name=self.stackDict[self.name]['template-bucket'],
+                    region=self.region,
+                    prefix=self.stackDict[self.name].get('template-prefix', ''),
+                    s3conn=s3conn,
+                    offline=from_snapshot is not None
+                )
         except boto.exception.NoAuthHandlerFound as e:
-            self.logger.critical("No credentials found for connecting to cloudformation: %s" % e )
+            self.logger.critical("No credentials found for connecting to AWS: %s" % e )
             exit(1)
 
         #iterate through the stacks in the yaml file and create CFstack objects for them
@@ -82,47 +133,74 @@ class MegaStack:
                             region=self.region,
                             sns_topic_arn=local_sns_arn,
                             depends_on=the_stack['depends'],
-                            tags=merged_tags
+                            tags=merged_tags,
+                            cf_pool=self.cf_pool,
+                            resolution_cache=self.resolution_cache,
+                            template_store=self.template_store,
+                            fingerprint_cache=fingerprint_cache
                         )
                     )
 
     def sort_stacks_by_deps(self):
         """
         Sort the array of stack_objs so they are in dependancy order
+        Stacks depend on the stacks listed in depends in the yaml file and on the stacks they take param values from
         """
-        sorted_stacks = []
-        dep_graph = {}
-        no_deps = []
-        #Add all stacks without dependancies to no_deps
-        for stack in self.stack_objs:
-            if stack.depends_on is None:
-                no_deps.append(stack)
-            else:
-                dep_graph[stack.name] = stack.depends_on[:]
-        #Perform a topological sort on stacks in dep_graph
-        while len(no_deps) > 0:
-            stack = no_deps.pop()
-            sorted_stacks.append(stack)
-            for node in dep_graph.keys():
-                for deps in dep_graph[node]:
-                    if stack.cf_stack_name == deps:
-                        dep_graph[node].remove(stack.cf_stack_name)
-                        if len(dep_graph[node]) < 1:
-                            for n in self.stack_objs:
-                                if n.name == node:
-                                    no_deps.append(n)
-                            del(dep_graph[node])
-        if len(dep_graph) > 0:
-            self.logger.critical("Could not resolve dependancy order. Either circular dependancy or dependancy on stack not in yaml file.")
+        listed_deps = self.infer_deps()
+        self.dep_graph = DepGraph(self.stack_objs)
+        try:
+            self.stack_objs = self.dep_graph.sorted_stacks()
+        except DependencyError as e:
+            self.logger.critical("Could not resolve dependancy order. %s" % e)
             exit(1)
-        else:
-            self.stack_objs = sorted_stacks
-            return True
-    
+        names = dict([(stack.cf_stack_name, stack.name) for stack in self.stack_objs])
+        for stack_name, redundant in sorted(self.dep_graph.redundant_deps().items()):
+            for dep, other in redundant:
+                if dep in listed_deps[stack_name]:
+                    self.logger.warning("Stack %s lists %s in depends, but it already depends on it through %s" % (names[stack_name], names[dep], names[other]))
+        return True
+
+    def infer_deps(self):
+        """
+        Add the stacks in the mega stack that each stack takes param values from to its depends_on, warning
+        about any that aren't listed in depends in the yaml file. Returns the depends from the yaml file
+        keyed by cf_stack_name.
+        """
+        names = dict([(stack.cf_stack_name, stack.name) for stack in self.stack_objs])
+        listed_deps = {}
+        for stack in sorted(self.stack_objs, key=lambda stack: stack.name):
+            listed_deps[stack.cf_stack_name] = list(stack.depends_on or [])
+            for source_stack, var_type in stack.param_refs():
+                if source_stack not in names or source_stack == stack.cf_stack_name or source_stack in (stack.depends_on or []):
+                    continue
+                self.logger.warning("Stack %s takes values from %s but doesn't list it in depends, adding the dependency" % (stack.name, names[source_stack]))
+                stack.depends_on = (stack.depends_on or []) + [source_stack]
+        return listed_deps
+
+    def prefetch_params(self, stack_name = None, stacks = None):
+        """
+        Look up every value the stacks pull from other stacks up front, grouped by source stack and
+        fetched concurrently, rather than one at a time as each stack's params are populated.
+        Only sources that already exist in cloudformation are fetched. If stacks is given only their values are fetched.
+        """
+        refs = []
+        for stack in stacks or self.stack_objs:
+            if stack_name and stack.name != stack_name:
+                continue
+            for source_stack, var_type in stack.param_refs():
+                if source_stack in self.cf_desc_stacks:
+                    refs.append((source_stack, var_type))
+        self.resolution_cache.prefetch(refs, max_workers = self.cf_pool.size)
+
     def check(self, stack_name = None):
         """
         Checks the status of the yaml file. Displays parameters for the stacks it can.
         """
+        if self.dep_graph and not stack_name:
+            for i, wave in enumerate(self.dep_graph.stack_waves()):
+                self.logger.info("Wave %s, can be processed together: %s" % (i + 1, [stack.name for stack in wave]))
+        self.report_template_sizes(stack_name)
+        self.prefetch_params(stack_name)
         for stack in self.stack_objs:
             if stack_name and stack.name != stack_name:
                 continue
@@ -134,135 +212,625 @@ class MegaStack:
                 self.logger.info("Stack %s would be created with following parameter values: %s" % (stack.cf_stack_name, stack.get_params_tuples()))
                 self.logger.info("Stack %s already exists in CF: %s" % (stack.cf_stack_name, bool(stack.exists_in_cf(self.cf_desc_stacks))))
     
-    def create(self, stack_name = None):
+    def snapshot(self, snapshot_file):
+        """
+        Save everything cumulus needs from cloudformation about this mega stack, and the stacks outside it
+        that it pulls values from, to snapshot_file. If the file already has a snapshot, only stacks
+        updated since it was taken are fetched again.
+        """
+        stack_names = []
+        for stack in self.stack_objs:
+            stack_names.append(stack.cf_stack_name)
+            stack_names.extend([source_stack for source_stack, var_type in stack.param_refs()])
+        the_snapshot = None
+        if os.path.exists(snapshot_file):
+            try:
+                the_snapshot = load_snapshot(snapshot_file)
+            except SnapshotError as e:
+                self.logger.warning("%s, taking a new snapshot" % e)
+            if the_snapshot and (the_snapshot.mega_stack_name != self.name or the_snapshot.region != self.region):
+                self.logger.warning("Snapshot file %s is of a different mega stack, taking a new snapshot" % snapshot_file)
+                the_snapshot = None
+        if the_snapshot is None:
+            the_snapshot = RegionSnapshot(self.name, self.region)
+        fetched, reused = the_snapshot.refresh(self.cfconn, self.cf_desc_stacks, stack_names)
+        the_snapshot.save(snapshot_file)
+        self.logger.info("Saved snapshot of %s stacks to %s, %s fetched and %s unchanged since the last snapshot" % (len(the_snapshot.stacks), snapshot_file, fetched, reused))
+
+    def report_template_sizes(self, stack_name = None):
+        """
+        Log the size of each stack's template against the cloudformation limits for inline and S3 hosted templates,
+        warning about any that are close to the limit that applies to them
+        """
+        for stack in self.stack_objs:
+            if stack_name and stack.name != stack_name:
+                continue
+            stack.read_template()
+            size = len(stack.template_body)
+            limit = stack.template_size_limit()
+            message = "Template for stack %s is %s bytes, %.1f%% of the inline limit (%s) and %.1f%% of the S3 limit (%s)" % (
+                    stack.name, size, 100.0 * size / TEMPLATE_BODY_LIMIT, TEMPLATE_BODY_LIMIT, 100.0 * size / TEMPLATE_URL_LIMIT, TEMPLATE_URL_LIMIT)
+            if size > limit:
+                self.logger.error(message + ", too big to %s" % ("upload" if stack.template_store else "pass inline, set template-bucket to pass it by URL"))
+            elif size > limit * 0.9:
+                self.logger.warning(message + ", close to the limit")
+            else:
+                self.logger.info(message)
+
+    def check_template_sizes(self, stacks):
+        """
+        Make sure none of the templates of stacks are too big for cloudformation before any stack is changed,
+        so a run doesn't stop half way through. Exits if any are.
+        """
+        too_big = []
+        for stack in stacks:
+            stack.read_template()
+            if not stack.template_size_ok():
+                too_big.append(stack.name)
+        if too_big:
+            self.logger.critical("Not changing any stacks, templates of stacks %s are too big" % too_big)
+            exit(1)
+
+    def create(self, stack_name = None, parallel = 1, keep_going = False, journal = None):
         """
         Create all stacks in the yaml file. Any that already exist are skipped (no attempt to update)
+        If parallel is more than 1, independent stacks are created concurrently, up to parallel at a time
+        If keep_going is set, stacks that don't depend on a failed stack are still created
+        If journal is given each stack is recorded in it, and stacks the run it resumes finished are skipped
         """
+        self.keep_going = keep_going
+        self.journal = journal
+        create_stack = self.journaled('create', self.create_stack)
+        self.prefetch_params(stack_name)
+        operations = dict([(stack.cf_stack_name, 'create') for stack in self.stack_objs
+                           if (not stack_name or stack.name == stack_name) and not stack.exists_in_cf(self.cf_desc_stacks)])
+        self.check_template_sizes([stack for stack in self.stack_objs if stack.cf_stack_name in operations])
+        durations = self.estimate_run(operations, parallel if not stack_name else 1)
+        if (parallel > 1 or keep_going) and not stack_name:
+            self.logger.info("Creating stacks in parallel, up to %s at a time" % parallel)
+            self.run_scheduler(StackScheduler(self.stack_objs, create_stack, max_workers = parallel, durations = durations, keep_going = keep_going))
+            return
         for stack in self.stack_objs:
             if stack_name and stack.name != stack_name:
                 continue
-            self.logger.info("Starting checks for creation of stack: %s" % stack.name)
-            if stack.exists_in_cf(self.cf_desc_stacks):
-                self.logger.info("Stack %s already exists in cloudformation, skipping" % stack.name)
+            if not create_stack(stack):
+                exit(1)
+
+    def create_stack(self, stack):
+        """
+        Create a single stack and wait for it to finish. Returns True if the stack was created or
+        already exists, False if anything went wrong.
+        """
+        self.logger.info("Starting checks for creation of stack: %s" % stack.name)
+        if stack.exists_in_cf(self.cf_desc_stacks):
+            self.logger.info("Stack %s already exists in cloudformation, skipping" % stack.name)
+            return True
+        if stack.deps_met(self.cf_desc_stacks) is False:
+            #Stacks we depend on may have been created outside this run, check again with a fresh list
+            self.invalidate_cf_desc_stacks()
+            if stack.deps_met(self.cf_desc_stacks) is False:
+                self.logger.critical("Dependancies for stack %s not met and they should be, exiting..." % stack.name)
+                return False
+        if not stack.populate_params(self.cf_desc_stacks):
+            self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
+            return False
+        return self.apply_create(stack)
+
+    def apply_create(self, stack):
+        """
+        Send the create for a stack to cloudformation and wait for it to finish. Returns True on success.
+        Needs the stack's params to have been populated.
+        """
+        stack.read_template()
+        if not stack.template_size_ok():
+            return False
+        self.logger.info("Creating: %s, %s" % (stack.cf_stack_name, stack.get_params_tuples()))
+        stack.forget_fingerprint()
+        try:
+            self.cfconn.create_stack(
+                stack_name=stack.cf_stack_name,
+                parameters=stack.get_params_tuples(),
+                capabilities=['CAPABILITY_IAM'],
+                notification_arns=stack.sns_topic_arn,
+                tags=stack.stack_tags(),
+                **stack.template_args()
+            )
+        except Exception as e:
+            self.logger.critical("Creating stack %s failed. Error: %s" % (stack.cf_stack_name, e))
+            return False
+
+        create_result = self.watch_events(stack.cf_stack_name, "CREATE_IN_PROGRESS", operation = 'create')
+        if create_result != "CREATE_COMPLETE":
+            self.logger.critical("Stack %s didn't create correctly, status is now %s" % (stack.cf_stack_name, create_result))
+            return False
+
+        #CF told us stack completed ok. Log message to that effect and refresh the list of stack objects in CF
+        self.logger.info("Finished creating stack: %s" % stack.cf_stack_name)
+        self.refresh_cf_stack(stack)
+        self.record_inputs(stack, changed = True)
+        return True
+
+    def journaled(self, operation, action, record = True):
+        """
+        Wrap a per stack action for the run journal, if there is one. Stacks the run being resumed finished
+        are skipped, and anything it left in progress is waited for before carrying on with the stack.
+        If record is set the start and finish of the action are written to the journal.
+        """
+        if self.journal is None:
+            return action
+        def journaled_action(stack):
+            if self.journal.finished_before(stack):
+                self.logger.info("Stack %s was finished by the run being resumed, skipping" % stack.name)
+                if operation == 'update':
+                    self.stacks_uptodate[stack.cf_stack_name] = True
+                return True
+            if self.journal.in_flight_before(stack) and not self.settle_stack(stack):
+                return False
+            if not record:
+                return action(stack)
+            self.journal.started(stack)
+            succeeded = action(stack)
+            self.journal.finished(stack, succeeded, self.cf_desc_stacks.status(stack.cf_stack_name))
+            return succeeded
+        return journaled_action
+
+    def settle_stack(self, stack):
+        """
+        Wait for cloudformation to finish anything the run being resumed left in progress on a stack.
+        Returns False if the stack ended up broken.
+        """
+        status = self.cf_desc_stacks.status(stack.cf_stack_name)
+        if status in IN_PROGRESS_STATUSES:
+            self.logger.info("Stack %s was left %s by the run being resumed, waiting for it to finish" % (stack.name, status))
+            status = self.watch_events(stack.cf_stack_name, IN_PROGRESS_STATUSES)
+            self.refresh_cf_stack(stack)
+        if status in BROKEN_STATUSES:
+            self.logger.critical("Stack %s is %s after the run being resumed, it needs to be fixed by hand" % (stack.name, status))
+            return False
+        return True
+
+    def run_scheduler(self, scheduler):
+        """
+        Run a StackScheduler, exiting if any stack failed. Logs the result of every stack when keeping going or if anything failed.
+        """
+        succeeded = scheduler.run()
+        if self.keep_going or not succeeded:
+            self.log_results(scheduler)
+        if not succeeded:
+            exit(1)
+
+    def log_results(self, scheduler):
+        """
+        Log what happened to each stack in a StackScheduler run
+        """
+        by_name = dict([(stack.cf_stack_name, stack) for stack in scheduler.stacks])
+        counts = {}
+        self.logger.info("Results:")
+        for stack in scheduler.stacks:
+            if stack.cf_stack_name in scheduler.skipped:
+                result = "skipped, depends on failed stack %s" % by_name[scheduler.skipped[stack.cf_stack_name]].name
+                counts['skipped'] = counts.get('skipped', 0) + 1
+            elif stack.cf_stack_name not in scheduler.results:
+                result = "not started"
+                counts['not started'] = counts.get('not started', 0) + 1
+            elif scheduler.results[stack.cf_stack_name]:
+                result = "ok"
+                counts['ok'] = counts.get('ok', 0) + 1
             else:
-                if stack.deps_met(self.cf_desc_stacks) is False:
-                    self.logger.critical("Dependancies for stack %s not met and they should be, exiting..." % stack.name)
-                    exit(1)
-                if not stack.populate_params(self.cf_desc_stacks):
-                    self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
-                    exit(1)
-                
-                stack.read_template()
-                self.logger.info("Creating: %s, %s" % (stack.cf_stack_name, stack.get_params_tuples()))
-                try:
-                    self.cfconn.create_stack(
-                        stack_name=stack.cf_stack_name,
-                        template_body=stack.template_body,
-                        parameters=stack.get_params_tuples(),
-                        capabilities=['CAPABILITY_IAM'],
-                        notification_arns=stack.sns_topic_arn,
-                        tags=stack.tags
-                    )
-                except Exception as e:
-                    self.logger.critical("Creating stack %s failed. Error: %s" % (stack.cf_stack_name, e))
-                    exit(1)
+                result = "FAILED"
+                counts['failed'] = counts.get('failed', 0) + 1
+            self.logger.info("    %s: %s" % (stack.name, result))
+        self.logger.info("%s stacks ok, %s failed, %s skipped, %s not started" % (counts.get('ok', 0), counts.get('failed', 0), counts.get('skipped', 0), counts.get('not started', 0)))
+
+    def refresh_cf_stack(self, stack):
+        """
+        Re-describe a single stack after we've changed it and patch it into cf_desc_stacks,
+        rather than pulling every stack in the region again
+        """
+        self.cf_desc_stacks.refresh_stack(self.cfconn, stack.cf_stack_name)
+        self.resolution_cache.invalidate(stack.cf_stack_name)
+
+    def invalidate_cf_desc_stacks(self):
+        """
+        Throw away everything we know about stacks in cloudformation and describe the whole region again.
+        Only needed when something outside this run may have changed stacks.
+        """
+        self.logger.info("Refreshing list of stacks in cloudformation")
+        self.cf_desc_stacks.refresh(self.cfconn)
+        self.resolution_cache.clear()
+
+    def plan(self, plan_file):
+        """
+        Work out what an update or create of every stack would do and save it to plan_file, to be run later by apply.
+        Stacks whose params can't be resolved yet, because stacks they depend on don't exist, are planned
+        for creation and have their params resolved when the plan is applied.
+        """
+        self.prefetch_params()
+        waves = [[stack.cf_stack_name for stack in wave] for wave in self.dep_graph.stack_waves()]
+        the_plan = StackPlan(self.name, self.region, waves=waves)
+        for stack in self.stack_objs:
+            stack.read_template()
+            if not stack.template_size_ok():
+                exit(1)
+            exists = stack.exists_in_cf(self.cf_desc_stacks)
+            resolved = stack.populate_params(self.cf_desc_stacks)
+            if not exists:
+                operation = 'create'
+            elif not resolved:
+                self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
+                exit(1)
+            elif stack.template_uptodate(self.cf_desc_stacks) and stack.params_uptodate(self.cf_desc_stacks):
+                operation = 'none'
+            else:
+                operation = 'update'
+            the_plan.add_stack(stack, operation, resolved, self.cf_desc_stacks.status(stack.cf_stack_name), self.cf_desc_stacks.last_updated(stack.cf_stack_name))
+            self.logger.info("Plan for stack %s: %s%s" % (stack.name, operation, "" if resolved else " (params resolved when applied)"))
+        the_plan.save(plan_file)
+        counts = dict([(operation, len([s for s in the_plan.stacks.values() if s['operation'] == operation])) for operation in ('create', 'update', 'none')])
+        self.logger.info("Saved plan to %s: %s to create, %s to update, %s unchanged, in %s waves" % (plan_file, counts['create'], counts['update'], counts['none'], len(waves)))
+
+    def apply(self, plan_file, parallel = 1, keep_going = False):
+        """
+        Carry out a plan saved by plan. Stacks that haven't changed since the plan was made use the planned
+        params and operation without checking cloudformation again, any that have are checked from scratch.
+        If keep_going is set, stacks that don't depend on a failed stack are still applied
+        """
+        self.keep_going = keep_going
+        try:
+            self.plan_to_apply = load_plan(plan_file)
+        except PlanError as e:
+            self.logger.critical(str(e))
+            exit(1)
+        if self.plan_to_apply.mega_stack_name != self.name or self.plan_to_apply.region != self.region:
+            self.logger.critical("Plan %s is for mega stack %s in %s, not %s in %s" % (plan_file, self.plan_to_apply.mega_stack_name, self.plan_to_apply.region, self.name, self.region))
+            exit(1)
+        missing = [stack.name for stack in self.stack_objs if not self.plan_to_apply.entry(stack.cf_stack_name)]
+        if missing:
+            self.logger.critical("Plan %s doesn't include stacks %s, make a new plan" % (plan_file, missing))
+            exit(1)
+        self.logger.info("Applying plan %s made at %s" % (plan_file, self.plan_to_apply.created))
+        self.stacks_uptodate = {}
+        self.stacks_updated = set()
+        operations = dict([(name, entry['operation']) for name, entry in self.plan_to_apply.stacks.items() if entry['operation'] != 'none'])
+        self.check_template_sizes([stack for stack in self.stack_objs if stack.cf_stack_name in operations])
+        durations = self.estimate_run(operations, parallel)
+        if parallel > 1 or keep_going:
+            self.run_scheduler(StackScheduler(self.stack_objs, self.apply_planned_stack, max_workers = parallel, durations = durations, keep_going = keep_going))
+            return
+        for stack in self.stack_objs:
+            if not self.apply_planned_stack(stack):
+                exit(1)
+
+    def plan_drift(self, stack, entry):
+        """
+        Returns the reason the plan for a stack can't be trusted any more, or None if it can
+        """
+        if stack.template_hash() != entry['template_sha256']:
+            return "template changed"
+        if yaml_params_hash(stack) != entry['yaml_params_sha256']:
+            return "params in yaml file changed"
+        if self.cf_desc_stacks.status(stack.cf_stack_name) != entry['cf_status'] or self.cf_desc_stacks.last_updated(stack.cf_stack_name) != entry['cf_last_updated']:
+            return "stack changed in cloudformation"
+        updated_deps = [dep for dep in stack.depends_on or [] if dep in self.stacks_updated]
+        if updated_deps and entry['params'] is not None:
+            return "stacks %s it depends on were updated" % updated_deps
+        return None
 
-                create_result = self.watch_events(stack.cf_stack_name, "CREATE_IN_PROGRESS")
-                if create_result != "CREATE_COMPLETE":
-                    self.logger.critical("Stack didn't create correctly, status is now %s" % create_result)
-                    exit(1)
-                
-                #CF told us stack completed ok. Log message to that effect and refresh the list of stack objects in CF
-                self.logger.info("Finished creating stack: %s" % stack.cf_stack_name)
-                self.cf_desc_stacks = self.cfconn.describe_stacks()
+    def apply_planned_stack(self, stack):
+        """
+        Carry out the planned operation for a single stack
+        """
+        entry = self.plan_to_apply.entry(stack.cf_stack_name)
+        drift = self.plan_drift(stack, entry)
+        if drift:
+            self.logger.info("Stack %s has changed since the plan was made (%s), checking it again" % (stack.name, drift))
+            if not stack.exists_in_cf(self.cf_desc_stacks):
+                return self.create_stack(stack)
+            if not self.check_update(stack):
+                return False
+            if self.stacks_uptodate[stack.cf_stack_name]:
+                return True
+            return self.apply_update(stack)
+        if entry['operation'] == 'none':
+            self.logger.info("Stack %s is up to date in the plan, skipping..." % stack.name)
+            return True
+        if entry['params'] is None:
+            #Stacks it depends on didn't exist when the plan was made, so params have to be resolved now
+            return self.create_stack(stack)
+        stack.params = dict(entry['params'])
+        if entry['operation'] == 'create':
+            return self.apply_create(stack)
+        return self.apply_update(stack)
 
-    def delete(self, stack_name = None):
+    def delete(self, stack_name = None, parallel = 1, assume_yes = False, keep_going = False):
         """
         Delete all the stacks from cloudformation.
-        Does this in reverse dependency order. Prompts for confirmation before deleting each stack
+        Does this in reverse dependency order. Prompts for confirmation before deleting each stack, unless
+        assume_yes is set. If parallel is more than 1 or keep_going is set, shows the full list of stacks to
+        delete and asks for confirmation once, then deletes stacks concurrently as soon as everything depending
+        on them is gone. If keep_going is set, stacks that no failed stack depends on are still deleted
         """
+        self.keep_going = keep_going
+        if (parallel > 1 or keep_going) and not stack_name:
+            to_delete = [stack for stack in reversed(self.stack_objs) if stack.exists_in_cf(self.cf_desc_stacks)]
+            if not to_delete:
+                self.logger.info("None of the stacks exist in cloudformation, nothing to delete")
+                return
+            self.logger.info("The following stacks will be deleted, up to %s at a time:" % parallel)
+            for stack in to_delete:
+                self.logger.info("    %s (Name in CF: %s)" % (stack.name, stack.cf_stack_name))
+            if not assume_yes:
+                confirm = raw_input("Confirm you wish to delete all %s stacks listed above (type 'yes' if so): " % len(to_delete))
+                if not confirm == "yes":
+                    print "Not confirmed, exiting..."
+                    return
+            durations = self.estimate_run(dict([(stack.cf_stack_name, 'delete') for stack in to_delete]), parallel, reverse = True)
+            self.run_scheduler(StackScheduler(self.stack_objs, self.delete_stack, max_workers = parallel, reverse = True, durations = durations, keep_going = keep_going))
+            return
         #Removing stacks so need to do it in reverse dependancy order
         for stack in reversed(self.stack_objs):
             if stack_name and stack.name != stack_name:
                 continue
-            self.logger.info("Starting checks for deletion of stack: %s" % stack.name)
             if not stack.exists_in_cf(self.cf_desc_stacks):
+                self.logger.info("Starting checks for deletion of stack: %s" % stack.name)
                 self.logger.info("Stack %s doesn't exist in cloudformation, skipping" % stack.name)
-            else:
+                continue
+            if not assume_yes:
                 confirm = raw_input("Confirm you wish to delete stack %s (Name in CF: %s) (type 'yes' if so): " % (stack.name, stack.cf_stack_name))
                 if not confirm == "yes":
                     print "Not confirmed, skipping..."
                     continue
-                self.logger.info("Starting delete of stack %s" % stack.name)
-                self.cfconn.delete_stack(stack.cf_stack_name)
-                delete_result = self.watch_events(stack.cf_stack_name, "DELETE_IN_PROGRESS")
-                if delete_result != "DELETE_COMPLETE" and delete_result != "STACK_GONE":
-                    self.logger.critical("Stack didn't delete correctly, status is now %s" % delete_result)
-                    exit(1)
+            if not self.delete_stack(stack):
+                exit(1)
 
-                #CF told us stack completed ok. Log message to that effect and refresh the list of stack objects in CF
-                self.logger.info("Finished deleting stack: %s" % stack.cf_stack_name)
-                self.cf_desc_stacks = self.cfconn.describe_stacks()
+    def delete_stack(self, stack):
+        """
+        Delete a single stack and wait for it to go away. Returns True if the stack was deleted or
+        didn't exist, False if anything went wrong.
+        """
+        self.logger.info("Starting checks for deletion of stack: %s" % stack.name)
+        if not stack.exists_in_cf(self.cf_desc_stacks):
+            self.logger.info("Stack %s doesn't exist in cloudformation, skipping" % stack.name)
+            self.forget_inputs(stack)
+            return True
+        self.logger.info("Starting delete of stack %s" % stack.name)
+        self.cfconn.delete_stack(stack.cf_stack_name)
+        delete_result = self.watch_events(stack.cf_stack_name, "DELETE_IN_PROGRESS", operation = 'delete')
+        if delete_result != "DELETE_COMPLETE" and delete_result != "STACK_GONE":
+            self.logger.critical("Stack %s didn't delete correctly, status is now %s" % (stack.cf_stack_name, delete_result))
+            return False
+
+        #CF told us stack completed ok. Log message to that effect and refresh the list of stack objects in CF
+        self.logger.info("Finished deleting stack: %s" % stack.cf_stack_name)
+        self.refresh_cf_stack(stack)
+        self.forget_inputs(stack)
+        return True
 
-    def update(self, stack_name = None):
+    def diff(self, stack_name = None):
         """
-        Attempts to update each of the stacks if template or parameters are diffenet to whats currently in cloudformation
-        If a stack doesn't already exist. Logs critical error and exits.
+        Show what would change in each stack that exists in cloudformation if it was updated
         """
+        self.prefetch_params(stack_name)
         for stack in self.stack_objs:
             if stack_name and stack.name != stack_name:
                 continue
-            self.logger.info("Starting checks for update of stack: %s" % stack.name)
             if not stack.exists_in_cf(self.cf_desc_stacks):
-                self.logger.critical("Stack %s doesn't exist in cloudformation, can't update something that doesn't exist." % stack.name)
-                exit(1)
-            if not stack.deps_met(self.cf_desc_stacks):
-                self.logger.critical("Dependancies for stack %s not met and they should be, exiting..." % stack.name)
-                exit(1)
+                self.logger.info("Stack %s doesn't exist in cloudformation, it would be created" % stack.name)
+                continue
             if not stack.populate_params(self.cf_desc_stacks):
-                self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
-                exit(1)
+                self.logger.info("Could not determine correct parameters for stack %s, can't diff it" % stack.name)
+                continue
             stack.read_template()
             template_up_to_date = stack.template_uptodate(self.cf_desc_stacks)
-            params_up_to_date = stack.params_uptodate(self.cf_desc_stacks)
-            self.logger.debug("Stack is up to date: %s" % (template_up_to_date and params_up_to_date))
-            if template_up_to_date and params_up_to_date:
-                self.logger.info("Stack %s is already up to date with cloudformation, skipping..." % stack.name)
+            if template_up_to_date and stack.params_uptodate(self.cf_desc_stacks):
+                self.logger.info("Stack %s is up to date with cloudformation" % stack.name)
             else:
-                if not template_up_to_date:
-                    self.logger.info("Template for stack %s has changed." % stack.name)
-                    #Would like to get this working. Tried datadiff at the moment but can't stop it from printing whole template
-                    #stack.print_template_diff(self.cf_desc_stacks)
-                self.logger.info("Starting update of stack %s with parameters: %s" % (stack.name, stack.get_params_tuples()))
-                self.cfconn.validate_template(template_body = stack.template_body)
-                try:
-                    self.cfconn.update_stack(
-                            stack_name    = stack.cf_stack_name,
-                            template_body = stack.template_body,
-                            parameters    = stack.get_params_tuples(),
-                            capabilities  = ['CAPABILITY_IAM'],
-                            tags          = stack.tags
-                            )
-                except boto.exception.BotoServerError as e:
-                    e_message_dict = simplejson.loads(e.error_message)
-                    if str(e_message_dict["Error"]["Message"]) == "No updates are to be performed.":
-                        self.logger.error("Cloudformation has no updates to perform on %s, this might be because there is a parameter with NoEcho set" % stack.name)
-                        continue
-                    else:
-                        self.logger.debug("Got error message: %s" % e_message_dict["Error"]["Message"])
-                        raise e
-                update_result = self.watch_events(stack.cf_stack_name, ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"])
-                if update_result != "UPDATE_COMPLETE":
-                    self.logger.critical("Stack didn't update correctly, status is now %s" % update_result)
-                    exit(1)
-                
-                self.logger.info("Finished updating stack: %s" % stack.cf_stack_name)
+                self.log_diff(stack, template_up_to_date)
 
-    
-    def watch(self, stack_name):
+    def log_diff(self, stack, template_up_to_date = False):
+        """
+        Log the changes between a stack in cloudformation and our template and parameters
+        """
+        diff = stack.template_diff(self.cf_desc_stacks, include_template = not template_up_to_date)
+        if not diff:
+            self.logger.info("No structural changes to stack %s (formatting changes only)" % stack.name)
+            return
+        self.logger.info("Changes to stack %s:" % stack.name)
+        for line in diff.lines():
+            self.logger.info("    %s" % line)
+
+    def update(self, stack_name = None, parallel = 1, show_diff = False, keep_going = False, journal = None, changed_only = False):
+        """
+        Attempts to update each of the stacks if template or parameters are diffenet to whats currently in cloudformation
+        If a stack doesn't already exist. Logs critical error and exits.
+        If parallel is more than 1, all stacks are checked for changes at once and then the changed stacks are
+        updated concurrently in dependency order, up to parallel at a time
+        If show_diff is set, the changes to each stack are logged before it's updated
+        If keep_going is set, stacks that don't depend on a failed stack are still updated
+        If journal is given each stack is recorded in it, and stacks the run it resumes finished are skipped
+        without being checked again
+        If changed_only is set, only the stacks the input manifest says have changed and the stacks that depend
+        on them are checked, nothing is asked of cloudformation about the rest
+        """
+        self.show_diff = show_diff
+        self.keep_going = keep_going
+        self.journal = journal
+        self.stacks_uptodate = {}
+        self.stacks_updated = set()
+        self.failed_checks = set()
+        stacks = self.stack_objs
+        if changed_only:
+            stacks = self.changed_stacks()
+            if not stacks:
+                self.logger.info("No stacks have changed since they were last in sync with cloudformation")
+                return
+            self.logger.info("Skipping %s unchanged stacks" % (len(self.stack_objs) - len(stacks)))
+        self.check_template_sizes([stack for stack in stacks if not stack_name or stack.name == stack_name])
+        self.prefetch_params(stack_name, stacks)
+        if (parallel > 1 or keep_going) and not stack_name:
+            self.logger.info("Checking all stacks for changes, up to %s at a time" % parallel)
+            checker = StackScheduler(stacks, self.journaled('update', self.check_update, record = False), max_workers = parallel, ignore_deps = True, keep_going = keep_going)
+            if not checker.run() and not keep_going:
+                exit(1)
+            #Stacks that couldn't be checked fail in the update run, so the stacks that depend on them are skipped
+            self.failed_checks = set([name for name, result in checker.results.items() if not result])
+            changed = [stack.name for stack in stacks if stack.cf_stack_name not in self.failed_checks and not self.stacks_uptodate[stack.cf_stack_name]]
+            if not changed and not self.failed_checks:
+                self.logger.info("All stacks are already up to date with cloudformation")
+                return
+            self.logger.info("Stacks with changes: %s" % changed)
+            operations = dict([(stack.cf_stack_name, 'update') for stack in stacks if stack.name in changed])
+            durations = self.estimate_run(operations, parallel, stacks = stacks)
+            self.run_scheduler(StackScheduler(stacks, self.journaled('update', self.update_changed_stack), max_workers = parallel, durations = durations, keep_going = keep_going))
+            return
+        update_stack = self.journaled('update', self.update_stack)
+        for stack in stacks:
+            if stack_name and stack.name != stack_name:
+                continue
+            if not update_stack(stack):
+                exit(1)
+
+    def update_stack(self, stack):
+        """
+        Check a single stack and update it if it's changed
+        """
+        if not self.check_update(stack):
+            return False
+        return self.stacks_uptodate[stack.cf_stack_name] or self.apply_update(stack)
+
+    def check_update(self, stack):
+        """
+        Work out if a stack needs updating. Stores the answer in self.stacks_uptodate and
+        returns False if the stack can't be checked.
+        """
+        self.logger.info("Starting checks for update of stack: %s" % stack.name)
+        if not stack.exists_in_cf(self.cf_desc_stacks):
+            self.logger.critical("Stack %s doesn't exist in cloudformation, can't update something that doesn't exist." % stack.name)
+            return False
+        if not stack.deps_met(self.cf_desc_stacks):
+            self.logger.critical("Dependancies for stack %s not met and they should be, exiting..." % stack.name)
+            return False
+        if not stack.populate_params(self.cf_desc_stacks):
+            self.logger.critical("Could not determine correct parameters for stack %s" % stack.name)
+            return False
+        stack.read_template()
+        if not stack.template_size_ok():
+            return False
+        template_up_to_date = stack.template_uptodate(self.cf_desc_stacks)
+        params_up_to_date = stack.params_uptodate(self.cf_desc_stacks)
+        self.logger.debug("Stack is up to date: %s" % (template_up_to_date and params_up_to_date))
+        if template_up_to_date and params_up_to_date:
+            self.logger.info("Stack %s is already up to date with cloudformation, skipping..." % stack.name)
+        else:
+            if not template_up_to_date:
+                self.logger.info("Template for stack %s has changed." % stack.name)
+            if self.show_diff:
+                self.log_diff(stack, template_up_to_date)
+        self.stacks_uptodate[stack.cf_stack_name] = template_up_to_date and params_up_to_date
+        if self.stacks_uptodate[stack.cf_stack_name]:
+            stack.record_fingerprint(self.cf_desc_stacks)
+            self.record_inputs(stack)
+        return True
+
+    def update_changed_stack(self, stack):
+        """
+        Used by parallel updates once every stack has been checked. Re-checks the stack if any stack it
+        depends on was updated during this run (its outputs may have changed), then updates it if needed.
+        """
+        if stack.cf_stack_name in self.failed_checks:
+            self.logger.error("Stack %s couldn't be checked for changes, not updating it" % stack.name)
+            return False
+        updated_deps = [dep for dep in stack.depends_on or [] if dep in self.stacks_updated]
+        if updated_deps:
+            self.logger.info("Stacks %s were updated, re-checking %s" % (updated_deps, stack.name))
+            if not self.check_update(stack):
+                return False
+        if self.stacks_uptodate[stack.cf_stack_name]:
+            return True
+        return self.apply_update(stack)
+
+    def apply_update(self, stack):
+        """
+        Send the update for a stack to cloudformation and wait for it to finish. Returns True on success.
+        """
+        self.logger.info("Starting update of stack %s with parameters: %s" % (stack.name, stack.get_params_tuples()))
+        self.cfconn.validate_template(**stack.template_args())
+        stack.forget_fingerprint()
+        try:
+            self.cfconn.update_stack(
+                    stack_name    = stack.cf_stack_name,
+                    parameters    = stack.get_params_tuples(),
+                    capabilities  = ['CAPABILITY_IAM'],
+                    tags          = stack.stack_tags(),
+                    **stack.template_args()
+                    )
+        except boto.exception.BotoServerError as e:
+            e_message_dict = simplejson.loads(e.error_message)
+            if str(e_message_dict["Error"]["Message"]) == "No updates are to be performed.":
+                self.logger.error("Cloudformation has no updates to perform on %s, this might be because there is a parameter with NoEcho set" % stack.name)
+                self.record_inputs(stack)
+                return True
+            else:
+                self.logger.debug("Got error message: %s" % e_message_dict["Error"]["Message"])
+                raise e
+        update_result = self.watch_events(stack.cf_stack_name, ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"], operation = 'update')
+        if update_result != "UPDATE_COMPLETE":
+            self.logger.critical("Stack %s didn't update correctly, status is now %s" % (stack.cf_stack_name, update_result))
+            return False
+
+        self.logger.info("Finished updating stack: %s" % stack.cf_stack_name)
+        #Outputs of this stack may have changed, make sure stacks that use them see the new values
+        stack.clear_cf_template()
+        self.stacks_updated.add(stack.cf_stack_name)
+        self.refresh_cf_stack(stack)
+        self.record_inputs(stack, changed = True)
+        return True
+
+    def record_inputs(self, stack, changed = False):
+        """
+        Record the inputs of a stack that is now in sync with cloudformation in the input manifest, if there is one.
+        If the stack was changed its outputs may have too, so the stacks that depend on it are dropped from
+        the manifest until they've been checked again.
+        """
+        if self.input_manifest is None:
+            return
+        self.input_manifest.record(stack)
+        if changed and self.dep_graph is not None:
+            self.input_manifest.forget(self.dep_graph.downstream([stack.cf_stack_name]) - set([stack.cf_stack_name]))
+
+    def forget_inputs(self, stack):
+        """
+        Drop a stack that's no longer in cloudformation from the input manifest, if there is one
+        """
+        if self.input_manifest is not None:
+            self.input_manifest.forget([stack.cf_stack_name])
+
+    def changed_stacks(self):
+        """
+        The stacks whose template file, params, tags or SNS topics have changed since they were last in sync
+        with cloudformation, according to the input manifest, plus every stack that depends on them.
+        Returned in dependency order.
+        """
+        changed = []
+        for stack in self.stack_objs:
+            changes = self.input_manifest.changes(stack)
+            if changes:
+                self.logger.info("Stack %s has changed since it was last in sync: %s" % (stack.name, ", ".join(changes)))
+                changed.append(stack.cf_stack_name)
+        dirty = self.dep_graph.downstream(changed)
+        if len(dirty) > len(changed):
+            self.logger.info("Also checking stacks that depend on them: %s" % [stack.name for stack in self.stack_objs
+                                                                            if stack.cf_stack_name in dirty and stack.cf_stack_name not in changed])
+        return [stack for stack in self.stack_objs if stack.cf_stack_name in dirty]
+
+    def watch(self, stack_name, watch_all = False):
         """
         Watch events for a given cloudformation stack. It will keep watching until its state changes
+        stack_name can be a comma separated list of stacks, or watch_all set to watch every stack in the
+        mega stack. Events from all of them are shown together until none are in progress any more.
         """
+        if watch_all or (stack_name and ',' in stack_name):
+            return self.watch_many(stack_name, watch_all)
         if not stack_name:
             self.logger.critical("No stack name passed in, nothing to watch... use -s to provide stack name.")
             exit(1)
@@ -281,41 +849,92 @@ class MegaStack:
         self.logger.info("Watching stack %s, while in state %s." % (the_stack.cf_stack_name, str(the_cf_stack.stack_status)))
         self.watch_events(the_stack.cf_stack_name, str(the_cf_stack.stack_status))
 
+    def watch_many(self, stack_names, watch_all = False):
+        """
+        Watch several stacks at once from one loop, prefixing each event with the stack it's from
+        """
+        if watch_all:
+            stacks = self.stack_objs
+        else:
+            names = [name.strip() for name in stack_names.split(',') if name.strip()]
+            stacks = [stack for stack in self.stack_objs if stack.name in names]
+            missing = set(names) - set([stack.name for stack in stacks])
+            if missing:
+                self.logger.error("Cannot find stacks %s to watch" % sorted(missing))
+                return False
+        cf_stack_names = []
+        for stack in stacks:
+            if stack.exists_in_cf(self.cf_desc_stacks):
+                cf_stack_names.append(stack.cf_stack_name)
+            else:
+                self.logger.info("Stack %s doesn't exist in cloudformation, not watching it." % stack.name)
+        watcher = StackWatcher(self.cfconn, cf_stack_names, self.log_event)
+        return watcher.run()
 
-    def watch_events(self, stack_name, while_status):
+    def watch_events(self, stack_name, while_status, operation = None):
         """
         Used by the various actions to watch cloudformation events while a stacks in a given state
+        If operation (create, update or delete) is given and it succeeds, how long it took is recorded in the duration history
         """
-        try:
-            cfstack_obj = self.cfconn.describe_stacks(stack_name)[0]
-            events = list(self.cfconn.describe_stack_events(stack_name))
-        except boto.exception.BotoServerError as e:
-            if str(e.error_message) == "Stack:%s does not exist" % (stack_name):
-                return "STACK_GONE"
+        started = time.time()
+        tailer = EventTailer(self.cfconn, stack_name)
+        events = tailer.start()
+        if tailer.status == "STACK_GONE":
+            self.record_duration(stack_name, operation, tailer.status, time.time() - started)
+            return "STACK_GONE"
         #print the last 5 events, so we get to see the start of the action we are performing
         self.logger.info("Last 5 events for this stack:")
-        for e in reversed(events[:5]):
-            self.logger.info("%s %s %s %s %s %s" % (e.timestamp.isoformat(), e.resource_status, e.resource_type, e.logical_resource_id, e.physical_resource_id, e.resource_status_reason))
-        status = str(cfstack_obj.stack_status)
+        for event in events:
+            self.log_event(event)
         self.logger.info("New events:")
-        while status in while_status:
-            try:
-                new_events = list(self.cfconn.describe_stack_events(stack_name))
-            except boto.exception.BotoServerError as e:
-                if str(e.error_message) == "Stack:%s does not exist" % (stack_name):
-                    return "STACK_GONE"
-            x = 0
-            events_to_log = []
-            while events[0].timestamp != new_events[x].timestamp or events[0].logical_resource_id != new_events[x].logical_resource_id:
-                events_to_log.insert(0, new_events[x])
-                x += 1
-            for event in events_to_log:
-                self.logger.info("%s %s %s %s %s %s" % (event.timestamp.isoformat(), event.resource_status, event.resource_type, event.logical_resource_id, event.physical_resource_id, event.resource_status_reason))
-            if x > 0:
-                events = new_events[:]
-            cfstack_obj.update()
-            status = str(cfstack_obj.stack_status)
-            time.sleep(5)
-        return status
+        while tailer.status in while_status:
+            tailer.wait()
+            for event in tailer.poll():
+                self.log_event(event)
+        self.record_duration(stack_name, operation, tailer.status, tailer.duration() or time.time() - started)
+        return tailer.status
+
+    def record_duration(self, stack_name, operation, status, seconds):
+        if self.duration_history is None or operation is None:
+            return
+        if status == "%s_COMPLETE" % operation.upper() or (operation == 'delete' and status == "STACK_GONE"):
+            self.logger.debug("%s of stack %s took %.0f seconds" % (operation, stack_name, seconds))
+            self.duration_history.record(stack_name, operation, seconds)
 
+    def estimate_run(self, operations, parallel = 1, reverse = False, stacks = None):
+        """
+        Work out how long each stack should take from the duration history and log how long the whole run should take.
+        operations maps the cf_stack_name of each stack that will be changed to create, update or delete,
+        the other stacks take no time. Stacks that have never been timed are assumed to take the average of the rest.
+        Returns the durations keyed by cf_stack_name, for StackScheduler. stacks defaults to all the stacks.
+        """
+        stacks = stacks or self.stack_objs
+        durations = dict([(stack.cf_stack_name, 0) for stack in stacks])
+        unknown = []
+        for name, operation in operations.items():
+            seconds = None
+            if self.duration_history is not None:
+                seconds = self.duration_history.estimate(name, operation)
+            if seconds is None:
+                unknown.append(name)
+            else:
+                durations[name] = seconds
+        known = [durations[name] for name in operations if name not in unknown]
+        for name in unknown:
+            #With no history at all every stack counts the same, so the longest chains of stacks still go first
+            durations[name] = sum(known) / len(known) if known else 1
+        if not operations:
+            return durations
+        if not known:
+            self.logger.info("No recorded durations for these stacks yet, can't estimate how long this will take")
+            return durations
+        seconds = StackScheduler(stacks, None, max_workers = parallel, reverse = reverse, durations = durations).estimate()
+        finish = datetime.datetime.now() + datetime.timedelta(seconds = seconds)
+        self.logger.info("Estimated time for %s stacks, up to %s at a time: %dm %02ds, finishing around %s%s" % (
+            len(operations), parallel, seconds / 60, seconds % 60, finish.strftime("%H:%M:%S"),
+            " (%s stacks haven't been timed before, assuming they take the average)" % len(unknown) if unknown else ""))
+        return durations
 
+    def log_event(self, event, stack_name = None):
+        prefix = "[%s] " % stack_name if stack_name else ""
+        self.logger.info("%s%s %s %s %s %s %s" % (prefix, event.timestamp.isoformat(), event.resource_status, event.resource_type, event.logical_resource_id, event.physical_resource_id, event.resource_status_reason))
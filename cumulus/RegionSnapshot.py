@@ -0,0 +1,190 @@
+import boto
+import datetime
+import gzip
+import hashlib
+import logging
+import simplejson
+from CFConnectionPool import paginate
+from StackIndex import last_updated_time
+
+
+class SnapshotError(Exception):
+    """
+    Raised when a snapshot file can't be read, or something is asked of a snapshot that it can't answer
+    """
+    pass
+
+
+class SnapshotValue:
+    """
+    A parameter, output or tag of a stack in a snapshot, looks like the boto objects with key and value
+    """
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class SnapshotResource:
+    def __init__(self, logical_resource_id, physical_resource_id):
+        self.logical_resource_id = logical_resource_id
+        self.physical_resource_id = physical_resource_id
+
+
+class SnapshotStack:
+    """
+    A stack read from a snapshot, with the same attributes cumulus uses from the boto stack objects
+    """
+    def __init__(self, entry):
+        self.stack_name = entry['stack_name']
+        self.stack_status = entry['stack_status']
+        self.creation_time = entry['creation_time']
+        #Named like boto's attribute, which keeps the API name
+        self.LastUpdatedTime = entry['last_updated_time']
+        self.parameters = [SnapshotValue(key, value) for key, value in sorted(entry['parameters'].items())]
+        self.outputs = [SnapshotValue(key, value) for key, value in sorted(entry['outputs'].items())]
+        self.tags = entry['tags']
+
+
+class SnapshotResultSet(list):
+    """
+    Everything in a snapshot fits in one page
+    """
+    next_token = None
+
+
+class SnapshotConnection:
+    """
+    Stands in for a cloudformation connection, answering the read calls cumulus makes from a snapshot.
+    Stacks that aren't in the snapshot don't exist, and anything that would change a stack raises SnapshotError.
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def entry(self, name):
+        if name not in self.snapshot.stacks:
+            raise boto.exception.BotoServerError(400, 'Bad Request', 'Stack:%s does not exist' % name)
+        return self.snapshot.stacks[name]
+
+    def describe_stacks(self, stack_name_or_id = None, next_token = None):
+        if stack_name_or_id:
+            return SnapshotResultSet([SnapshotStack(self.entry(stack_name_or_id))])
+        return SnapshotResultSet([SnapshotStack(entry) for entry in self.snapshot.stacks.values()])
+
+    def list_stack_resources(self, stack_name_or_id, next_token = None):
+        resources = self.entry(stack_name_or_id)['resources']
+        return SnapshotResultSet([SnapshotResource(logical, physical) for logical, physical in sorted(resources.items())])
+
+    def get_template(self, stack_name_or_id):
+        return {'GetTemplateResponse': {'GetTemplateResult': {'TemplateBody': self.entry(stack_name_or_id)['template_body']}}}
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            raise SnapshotError("%s isn't available when working from a snapshot" % name)
+        return call
+
+
+class RegionSnapshot:
+    """
+    A local copy of everything cumulus reads from cloudformation about a mega stack: the description,
+    parameters, outputs, tags (including the fingerprint), resources and template of each of its stacks
+    and of any stacks outside it that it pulls values from.
+    Used through connect in place of cloudformation.connect_to_region, so check, plan and diff can run
+    without making any calls to AWS.
+    Refreshing only fetches resources and templates for stacks whose last updated time has changed.
+    """
+    VERSION = 1
+
+    def __init__(self, mega_stack_name, region, stacks = None, created = None):
+        self.logger = logging.getLogger(__name__)
+        self.mega_stack_name = mega_stack_name
+        self.region = region
+        #Snapshot entries keyed by stack name
+        self.stacks = stacks or {}
+        self.created = created or datetime.datetime.utcnow().isoformat()
+
+    def refresh(self, cfconn, stack_index, stack_names):
+        """
+        Bring the snapshot up to date for stack_names, using a freshly refreshed StackIndex.
+        Returns the number of stacks fetched and the number reused from the existing snapshot.
+        """
+        fetched = 0
+        reused = 0
+        stacks = {}
+        for name in sorted(set(stack_names)):
+            cf_stack = stack_index.get(name)
+            if cf_stack is None:
+                continue
+            last_updated = stack_index.last_updated(name)
+            status = str(cf_stack.stack_status)
+            old_entry = self.stacks.get(name)
+            if old_entry and old_entry['last_updated'] == last_updated and old_entry['stack_status'] == status:
+                stacks[name] = old_entry
+                reused += 1
+                continue
+            self.logger.debug("Fetching resources and template of stack %s for snapshot" % name)
+            stacks[name] = self.stack_entry(cfconn, cf_stack, last_updated)
+            fetched += 1
+        self.stacks = stacks
+        self.created = datetime.datetime.utcnow().isoformat()
+        return fetched, reused
+
+    def stack_entry(self, cfconn, cf_stack, last_updated):
+        name = str(cf_stack.stack_name)
+        resources = dict([(str(r.logical_resource_id), str(r.physical_resource_id)) for r in paginate(cfconn.list_stack_resources, name)])
+        template_body = cfconn.get_template(name)['GetTemplateResponse']['GetTemplateResult']['TemplateBody']
+        tags = cf_stack.tags or {}
+        if not isinstance(tags, dict):
+            tags = dict([(str(tag.key), str(tag.value)) for tag in tags])
+        updated_time = last_updated_time(cf_stack)
+        return {
+            'stack_name': name,
+            'stack_status': str(cf_stack.stack_status),
+            'creation_time': str(cf_stack.creation_time),
+            'last_updated_time': str(updated_time) if updated_time else None,
+            'last_updated': last_updated,
+            'parameters': dict([(str(p.key), str(p.value)) for p in cf_stack.parameters]),
+            'outputs': dict([(str(o.key), str(o.value)) for o in cf_stack.outputs]),
+            'tags': dict([(str(key), str(value)) for key, value in tags.items()]),
+            'resources': resources,
+            'template_sha256': hashlib.sha256(template_body).hexdigest(),
+            'template_body': template_body,
+        }
+
+    def connect(self, region):
+        """
+        Drop in replacement for cloudformation.connect_to_region, for use with CFConnectionPool
+        """
+        if region != self.region:
+            raise SnapshotError("Snapshot is of %s, not %s" % (self.region, region))
+        return SnapshotConnection(self)
+
+    def save(self, path):
+        snapshot_file = gzip.open(path, 'wb')
+        snapshot_file.write(simplejson.dumps({
+            'version': self.VERSION,
+            'mega_stack': self.mega_stack_name,
+            'region': self.region,
+            'created': self.created,
+            'stacks': self.stacks,
+        }, sort_keys=True, separators=(',', ':')))
+        snapshot_file.close()
+
+
+def load_snapshot(path):
+    """
+    Read a snapshot saved with RegionSnapshot.save
+    """
+    try:
+        snapshot_file = gzip.open(path, 'rb')
+        data = simplejson.loads(snapshot_file.read())
+        snapshot_file.close()
+    except Exception as e:
+        raise SnapshotError("Cannot read snapshot file %s: %s" % (path, e))
+    if data.get('version') != RegionSnapshot.VERSION:
+        raise SnapshotError("Snapshot file %s is version %s, expected version %s" % (path, data.get('version'), RegionSnapshot.VERSION))
+    return RegionSnapshot(
+        mega_stack_name=data['mega_stack'],
+        region=data['region'],
+        stacks=data['stacks'],
+        created=data['created']
+    )
@@ -0,0 +1,132 @@
+import logging
+import Queue
+import threading
+from CFConnectionPool import paginate
+
+
+class ResolutionCache:
+    """
+    Cache of the values stacks can pull from other stacks: the parameters, outputs and resources
+    of each source stack, stored as dicts keyed by name (logical ID for resources).
+    Owned by MegaStack and shared by every CFStack, so each source stack is only looked up once
+    no matter how many stacks use it. MegaStack invalidates a source stack whenever it
+    creates, updates or deletes it.
+    """
+    TYPES = ('parameter', 'output', 'resource')
+
+    def __init__(self, cf_pool, region, stack_index = None):
+        self.logger = logging.getLogger(__name__)
+        self.cf_pool = cf_pool
+        self.region = region
+        #Optional StackIndex, parameters and outputs are taken from it rather than describing the stack again
+        self.stack_index = stack_index
+        self.lock = threading.Lock()
+        #Values keyed by (source stack, type)
+        self.values = {}
+        #One lock per source stack, so concurrent lookups of the same stack only fetch it once
+        self.fetch_locks = {}
+
+    def _fetch_lock(self, source_stack):
+        with self.lock:
+            return self.fetch_locks.setdefault(source_stack, threading.Lock())
+
+    def _fetch_stack(self, source_stack):
+        """
+        Store the parameters and outputs of a stack
+        """
+        the_stack = None
+        if self.stack_index is not None:
+            the_stack = self.stack_index.get(source_stack)
+        if the_stack is None:
+            self.logger.debug("Describing stack %s to resolve parameters" % source_stack)
+            the_stack = self.cf_pool.get(self.region).describe_stacks(source_stack)[0]
+        parameters = dict([(str(p.key), str(p.value)) for p in the_stack.parameters])
+        outputs = dict([(str(o.key), str(o.value)) for o in the_stack.outputs])
+        with self.lock:
+            self.values[(source_stack, 'parameter')] = parameters
+            self.values[(source_stack, 'output')] = outputs
+
+    def _fetch_resources(self, source_stack):
+        """
+        Store the logical to physical ID map of a stack's resources
+        """
+        self.logger.debug("Listing resources of stack %s to resolve parameters" % source_stack)
+        cfconn = self.cf_pool.get(self.region)
+        resources = dict([(str(r.logical_resource_id), str(r.physical_resource_id)) for r in paginate(cfconn.list_stack_resources, source_stack)])
+        with self.lock:
+            self.values[(source_stack, 'resource')] = resources
+
+    def get(self, source_stack, var_type):
+        """
+        Returns the dict of values of var_type (parameter, output or resource) for a stack,
+        fetching it from cloudformation if we don't have it already
+        """
+        key = (source_stack, var_type)
+        if key in self.values:
+            return self.values[key]
+        with self._fetch_lock(source_stack):
+            #Another thread may have fetched it while we were waiting
+            if key not in self.values:
+                if var_type == 'resource':
+                    self._fetch_resources(source_stack)
+                else:
+                    self._fetch_stack(source_stack)
+        return self.values[key]
+
+    def lookup(self, source_stack, var_type, var_name):
+        """
+        Returns a single value from a stack, or None if the stack doesn't have it
+        """
+        return self.get(source_stack, var_type).get(var_name)
+
+    def prefetch(self, refs, max_workers = 10):
+        """
+        Fetch everything in refs, a list of (source stack, var_type), with up to max_workers lookups at once.
+        Each source stack is described once for its parameters and outputs and listed once for its resources.
+        Errors are only logged, the same lookup is tried again (and fails properly) when the value is used.
+        """
+        jobs = []
+        for source_stack, var_type in set(refs):
+            if var_type not in self.TYPES or (source_stack, var_type) in self.values:
+                continue
+            #Parameters and outputs come from the same describe call
+            job = (source_stack, 'resource' if var_type == 'resource' else 'output')
+            if job not in jobs:
+                jobs.append(job)
+        if not jobs:
+            return
+        self.logger.debug("Prefetching %s lookups from %s source stacks" % (len(jobs), len(set([job[0] for job in jobs]))))
+        job_queue = Queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+        def worker():
+            while True:
+                try:
+                    source_stack, var_type = job_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.get(source_stack, var_type)
+                except Exception as e:
+                    self.logger.debug("Could not prefetch %s of stack %s: %s" % (var_type, source_stack, e))
+        workers = [threading.Thread(target=worker) for i in range(min(max_workers, len(jobs)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+    def invalidate(self, source_stack):
+        """
+        Forget everything about a stack, it will be fetched again next time it's needed
+        """
+        with self.lock:
+            for var_type in self.TYPES:
+                self.values.pop((source_stack, var_type), None)
+
+    def clear(self):
+        """
+        Forget everything about all stacks
+        """
+        with self.lock:
+            self.values = {}
@@ -0,0 +1,117 @@
+import datetime
+import logging
+import os
+import threading
+import simplejson
+from StackPlan import yaml_params_hash
+
+
+class JournalError(Exception):
+    """
+    Raised when a run can't be resumed from a journal file
+    """
+    pass
+
+
+class RunJournal:
+    """
+    Append only record of a create or update run, one JSON object per line, written as each stack
+    starts and finishes so it survives the run being killed.
+    Finished entries hold the stack's resolved params, fingerprint and status in cloudformation.
+    When resuming, the entries of the previous run tell which stacks it finished, which can be skipped
+    if their template and yaml params haven't changed since, and which it left in flight.
+    Raises IOError if the journal can't be opened. If writing to it fails later the run carries on
+    without it, with a warning.
+    """
+    def __init__(self, path, action, mega_stack_name, resume = False):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.action = action
+        self.mega_stack_name = mega_stack_name
+        self.lock = threading.Lock()
+        #Last entry for each stack in the run being resumed, keyed by cf_stack_name
+        self.previous = {}
+        if resume:
+            if os.path.exists(path):
+                self.load()
+            else:
+                self.logger.warning("No journal %s to resume from, starting from the top" % path)
+        self.journal_file = open(path, 'a' if resume else 'w')
+        self.write({'event': 'start', 'action': action, 'mega_stack': mega_stack_name, 'resume': resume})
+
+    def load(self):
+        journal_file = open(self.path, 'r')
+        lines = journal_file.readlines()
+        journal_file.close()
+        for i, line in enumerate(lines):
+            try:
+                entry = simplejson.loads(line)
+            except ValueError:
+                if i == len(lines) - 1:
+                    #Run was killed half way through writing the last line
+                    break
+                raise JournalError("Journal %s is corrupt at line %s" % (self.path, i + 1))
+            if entry['event'] == 'start':
+                if entry['action'] != self.action or entry['mega_stack'] != self.mega_stack_name:
+                    raise JournalError("Journal %s was written by the %s action for mega stack %s, can't resume the %s action for %s from it" % (
+                        self.path, entry['action'], entry['mega_stack'], self.action, self.mega_stack_name))
+            else:
+                self.previous[entry['stack']] = entry
+
+    def write(self, entry):
+        entry['time'] = datetime.datetime.utcnow().isoformat()
+        with self.lock:
+            if self.journal_file is None:
+                return
+            try:
+                self.journal_file.write(simplejson.dumps(entry, sort_keys=True) + "\n")
+                self.journal_file.flush()
+                os.fsync(self.journal_file.fileno())
+            except (IOError, OSError) as e:
+                self.logger.warning("Can't write to journal %s, carrying on without it: %s" % (self.path, e))
+                self.journal_file = None
+
+    def inputs(self, stack):
+        return {
+            'template_sha256': stack.template_hash(),
+            'yaml_params_sha256': yaml_params_hash(stack),
+        }
+
+    def started(self, stack):
+        entry = {'event': 'started', 'stack': stack.cf_stack_name}
+        entry.update(self.inputs(stack))
+        self.write(entry)
+
+    def finished(self, stack, succeeded, cf_status):
+        entry = {
+            'event': 'finished',
+            'stack': stack.cf_stack_name,
+            'succeeded': bool(succeeded),
+            'cf_status': cf_status,
+            'params': dict(stack.params) if succeeded else None,
+            'fingerprint': stack.fingerprint() if succeeded else None,
+        }
+        entry.update(self.inputs(stack))
+        self.write(entry)
+
+    def finished_before(self, stack):
+        """
+        True if the run being resumed finished the stack successfully and its inputs haven't changed since
+        """
+        entry = self.previous.get(stack.cf_stack_name)
+        if not entry or entry['event'] != 'finished' or not entry['succeeded']:
+            return False
+        inputs = self.inputs(stack)
+        return entry['template_sha256'] == inputs['template_sha256'] and entry['yaml_params_sha256'] == inputs['yaml_params_sha256']
+
+    def in_flight_before(self, stack):
+        """
+        True if the run being resumed started the stack but didn't see it finish
+        """
+        entry = self.previous.get(stack.cf_stack_name)
+        return entry is not None and entry['event'] == 'started'
+
+    def close(self):
+        with self.lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
@@ -0,0 +1,87 @@
+import boto
+import threading
+from CFConnectionPool import paginate
+
+
+def last_updated_time(cf_stack):
+    """
+    When a stack was last updated, or None if it never has been. boto doesn't parse LastUpdatedTime like
+    it does CreationTime, it's kept as the string cloudformation returned under its API name.
+    """
+    return getattr(cf_stack, 'LastUpdatedTime', None)
+
+
+class StackIndex:
+    """
+    The stacks currently in cloudformation, as returned by describe_stacks, indexed by stack name.
+    Built from describe_stacks and passed to CFStack methods in place of the plain list,
+    so looking up a stack doesn't mean scanning every stack in the region.
+    Iterating over it gives the stack objects, so code expecting the list still works.
+    After a stack is changed, refresh_stack patches just that stack in, full refreshes are only
+    needed when the whole index is known to be stale.
+    """
+    def __init__(self, cf_stacks = ()):
+        self.lock = threading.Lock()
+        self.stacks = {}
+        for stack in cf_stacks:
+            self.stacks[str(stack.stack_name)] = stack
+
+    def refresh(self, cfconn):
+        """
+        Replace the whole index with a fresh describe_stacks of the region, following pagination
+        """
+        stacks = dict([(str(stack.stack_name), stack) for stack in paginate(cfconn.describe_stacks)])
+        with self.lock:
+            self.stacks = stacks
+
+    def refresh_stack(self, cfconn, name):
+        """
+        Describe a single stack and patch it into the index. Removes it if it no longer exists.
+        Returns the stack object or None if it's gone.
+        """
+        try:
+            result = cfconn.describe_stacks(name)
+        except boto.exception.BotoServerError as e:
+            if "Stack:%s does not exist" % name not in str(e.error_message):
+                raise
+            result = []
+        with self.lock:
+            if len(result) == 0 or str(result[0].stack_status) == "DELETE_COMPLETE":
+                self.stacks.pop(name, None)
+                return None
+            self.stacks[name] = result[0]
+            return result[0]
+
+    def get(self, name):
+        """
+        Returns the stack object for a stack name, or None if it isn't in cloudformation
+        """
+        return self.stacks.get(name)
+
+    def status(self, name):
+        """
+        Returns the status of a stack, or None if it isn't in cloudformation
+        """
+        stack = self.stacks.get(name)
+        if stack is None:
+            return None
+        return str(stack.stack_status)
+
+    def last_updated(self, name):
+        """
+        Returns the time a stack was last updated, or created if it's never been updated, as a string.
+        None if it isn't in cloudformation
+        """
+        stack = self.stacks.get(name)
+        if stack is None:
+            return None
+        return str(last_updated_time(stack) or stack.creation_time)
+
+    def __contains__(self, name):
+        return name in self.stacks
+
+    def __iter__(self):
+        return iter(self.stacks.values())
+
+    def __len__(self):
+        return len(self.stacks)
@@ -0,0 +1,90 @@
+import datetime
+import hashlib
+import simplejson
+
+
+class PlanError(Exception):
+    """
+    Raised when a plan file can't be read or doesn't belong to the mega stack being applied
+    """
+    pass
+
+
+class StackPlan:
+    """
+    What an update or create of the whole mega stack would do, worked out in one go so it can be saved
+    to a file and applied later without resolving everything again.
+    For each stack the plan holds the intended operation (create, update or none), the resolved parameters,
+    template hash and fingerprint, and the state of the stack in cloudformation when the plan was made,
+    which is used to spot drift when the plan is applied.
+    """
+    VERSION = 1
+
+    def __init__(self, mega_stack_name, region, waves = None, stacks = None, created = None):
+        self.mega_stack_name = mega_stack_name
+        self.region = region
+        #Lists of stack names that can be processed together, in dependency order
+        self.waves = waves or []
+        #Plan entries keyed by cf_stack_name
+        self.stacks = stacks or {}
+        self.created = created or datetime.datetime.utcnow().isoformat()
+
+    def add_stack(self, stack, operation, params_resolved, cf_status, cf_last_updated):
+        """
+        Add a stack to the plan. Needs read_template to have been run on the stack, and populate_params
+        if params_resolved is set.
+        """
+        self.stacks[stack.cf_stack_name] = {
+            'name': stack.name,
+            'operation': operation,
+            'params': dict(stack.params) if params_resolved else None,
+            'yaml_params_sha256': yaml_params_hash(stack),
+            'template_file': stack.template_name,
+            'template_sha256': stack.template_hash(),
+            'fingerprint': stack.fingerprint() if params_resolved else None,
+            'depends_on': stack.depends_on,
+            'cf_status': cf_status,
+            'cf_last_updated': cf_last_updated,
+        }
+
+    def entry(self, cf_stack_name):
+        return self.stacks.get(cf_stack_name)
+
+    def save(self, path):
+        plan_file = open(path, 'w')
+        simplejson.dump({
+            'version': self.VERSION,
+            'mega_stack': self.mega_stack_name,
+            'region': self.region,
+            'created': self.created,
+            'waves': self.waves,
+            'stacks': self.stacks,
+        }, plan_file, sort_keys=True, indent=2)
+        plan_file.close()
+
+
+def yaml_params_hash(stack):
+    """
+    Hash of the params block of a stack in the yaml file, to tell if it has changed since a plan was made
+    """
+    return hashlib.sha256(simplejson.dumps(stack.yaml_params, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def load_plan(path):
+    """
+    Read a plan saved with StackPlan.save
+    """
+    try:
+        plan_file = open(path, 'r')
+        data = simplejson.load(plan_file)
+    except Exception as e:
+        raise PlanError("Cannot read plan file %s: %s" % (path, e))
+    if data.get('version') != StackPlan.VERSION:
+        raise PlanError("Plan file %s is version %s, expected version %s" % (path, data.get('version'), StackPlan.VERSION))
+    return StackPlan(
+        mega_stack_name=data['mega_stack'],
+        region=data['region'],
+        waves=data['waves'],
+        stacks=data['stacks'],
+        created=data['created']
+    )
@@ -0,0 +1,168 @@
+import heapq
+import logging
+import Queue
+import threading
+from CallMetrics import stack_context
+from DepGraph import DepGraph
+
+
+class StackScheduler:
+    """
+    Runs an action against a set of CFStack objects concurrently. Each stack is started as soon as
+    every stack it depends on has finished successfully, with at most max_workers stacks in flight.
+    When reverse is True the dependencies are flipped, so a stack only starts once everything that
+    depends on it has finished (used for deletes). When ignore_deps is True all stacks are started
+    straight away (used for read only checks).
+    If durations are given (seconds keyed by cf_stack_name), the ready stacks with the longest critical
+    path, the longest chain of stacks waiting on them, are started first. Otherwise they are started in
+    the order given.
+    When keep_going is True a failed stack only stops the stacks that depend on it (transitively), which
+    are skipped, while the rest of the stacks carry on.
+    """
+    def __init__(self, stacks, action, max_workers = 1, reverse = False, ignore_deps = False, durations = None, keep_going = False):
+        self.logger = logging.getLogger(__name__)
+        self.stacks = stacks
+        self.action = action
+        self.max_workers = max(1, max_workers)
+        self.reverse = reverse
+        self.ignore_deps = ignore_deps
+        self.durations = durations
+        self.keep_going = keep_going
+        #Result of the action for each stack, keyed by cf_stack_name
+        self.results = {}
+        #Stacks skipped because a stack they depend on failed, keyed by cf_stack_name, value is the failed stack's cf_stack_name
+        self.skipped = {}
+
+    def _build_graph(self):
+        """
+        Work out how many stacks each stack is waiting on and which stacks to release when it finishes
+        """
+        #Dependencies outside the set we were given are left out of the graph, they are assumed to be handled already
+        graph = DepGraph(self.stacks)
+        #Only wait on the dependencies that aren't already implied by others, it's less to track for the same order
+        if not self.ignore_deps:
+            graph.reduce()
+        if self.ignore_deps:
+            waiting_on = dict([(name, 0) for name in graph.stacks])
+            releases = dict([(name, []) for name in graph.stacks])
+        elif self.reverse:
+            waiting_on = dict([(name, len(deps)) for name, deps in graph.dependents.items()])
+            releases = graph.depends
+        else:
+            waiting_on = dict([(name, len(deps)) for name, deps in graph.depends.items()])
+            releases = graph.dependents
+        priority = {}
+        if self.durations is not None and not self.ignore_deps:
+            priority = graph.critical_paths(self.durations, reverse = self.reverse)
+        return waiting_on, releases, priority
+
+    def _take_next(self, ready, priority):
+        """
+        Remove and return the ready stack with the longest critical path, the first one given if they're equal
+        """
+        best = 0
+        for i, stack in enumerate(ready):
+            if priority.get(stack.cf_stack_name, 0) > priority.get(ready[best].cf_stack_name, 0):
+                best = i
+        return ready.pop(best)
+
+    def estimate(self):
+        """
+        Simulate the run with the durations given, returns the number of seconds it should take
+        """
+        durations = self.durations or {}
+        waiting_on, releases, priority = self._build_graph()
+        by_name = dict([(stack.cf_stack_name, stack) for stack in self.stacks])
+        ready = [stack for stack in self.stacks if waiting_on[stack.cf_stack_name] == 0]
+        #Heap of (time it finishes, order started, name) for the stacks in flight
+        running = []
+        started = 0
+        now = 0
+        while ready or running:
+            while ready and len(running) < self.max_workers:
+                name = self._take_next(ready, priority).cf_stack_name
+                heapq.heappush(running, (now + durations.get(name, 0), started, name))
+                started += 1
+            now, order, name = heapq.heappop(running)
+            for released in releases[name]:
+                waiting_on[released] -= 1
+                if waiting_on[released] == 0:
+                    ready.append(by_name[released])
+        return now
+
+    def _worker(self, stack, done_queue):
+        try:
+            with stack_context(stack.cf_stack_name):
+                result = bool(self.action(stack))
+        except SystemExit:
+            #The stack methods call exit() on fatal errors, only ends this thread so treat it as a failure
+            result = False
+        except Exception as e:
+            self.logger.critical("Unexpected error while processing stack %s: %s" % (stack.name, e))
+            result = False
+        done_queue.put((stack, result))
+
+    def _skip_dependents(self, failed_name, releases):
+        """
+        Mark every stack waiting on a failed stack, directly or through other stacks, as skipped
+        """
+        to_visit = list(releases[failed_name])
+        while to_visit:
+            name = to_visit.pop()
+            if name in self.skipped:
+                continue
+            self.skipped[name] = failed_name
+            to_visit.extend(releases[name])
+
+    def run(self):
+        """
+        Run the action on all stacks. Unless keep_going is set, stops starting new stacks as soon as one fails,
+        but waits for any stacks already in flight to finish. Returns True if every stack succeeded.
+        """
+        waiting_on, releases, priority = self._build_graph()
+        by_name = dict([(stack.cf_stack_name, stack) for stack in self.stacks])
+        ready = [stack for stack in self.stacks if waiting_on[stack.cf_stack_name] == 0]
+        done_queue = Queue.Queue()
+        in_flight = 0
+        failed = False
+
+        while True:
+            while ready and (self.keep_going or not failed) and in_flight < self.max_workers:
+                stack = self._take_next(ready, priority)
+                self.logger.debug("Starting worker for stack %s" % stack.name)
+                worker = threading.Thread(target=self._worker, args=(stack, done_queue))
+                worker.daemon = True
+                worker.start()
+                in_flight += 1
+            if in_flight == 0:
+                break
+            try:
+                #Use a timeout so the main thread still responds to Ctrl-C
+                stack, result = done_queue.get(True, 1)
+            except Queue.Empty:
+                continue
+            in_flight -= 1
+            self.results[stack.cf_stack_name] = result
+            if not result and self.keep_going:
+                failed = True
+                self._skip_dependents(stack.cf_stack_name, releases)
+                dependents = sorted([by_name[name].name for name, cause in self.skipped.items() if cause == stack.cf_stack_name])
+                if dependents:
+                    self.logger.error("Stack %s failed, skipping the stacks that depend on it %s and carrying on with the rest" % (stack.name, dependents))
+                else:
+                    self.logger.error("Stack %s failed, carrying on with the rest" % stack.name)
+                continue
+            if not result:
+                if not failed:
+                    self.logger.critical("Stack %s failed, waiting for %s in flight stacks to finish before exiting" % (stack.name, in_flight))
+                failed = True
+                continue
+            for name in releases[stack.cf_stack_name]:
+                waiting_on[name] -= 1
+                if waiting_on[name] == 0:
+                    ready.append(by_name[name])
+
+        if not failed and len(self.results) + len(self.skipped) != len(self.stacks):
+            self.logger.critical("Could not schedule all stacks, dependency graph is incomplete")
+            failed = True
+        return not failed
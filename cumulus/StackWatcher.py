@@ -0,0 +1,62 @@
+import heapq
+import logging
+import time
+from EventTailer import EventTailer
+
+
+class StackWatcher:
+    """
+    Watches the events of many stacks at once from a single loop. Each stack has its own EventTailer
+    and polling interval, but all polls share one rate budget of calls_per_second, so watching more
+    stacks means each one is polled less often rather than more calls being made.
+    Keeps going until every stack has left its in progress state.
+    """
+    def __init__(self, cfconn, stack_names, log_event, calls_per_second = 2):
+        self.logger = logging.getLogger(__name__)
+        self.cfconn = cfconn
+        self.stack_names = stack_names
+        #Called with each event and the name of the stack it belongs to
+        self.log_event = log_event
+        self.min_gap = 1.0 / calls_per_second
+        #Final status of each stack, keyed by stack name
+        self.results = {}
+
+    def in_progress(self, status):
+        return status is not None and status.endswith("_IN_PROGRESS")
+
+    def run(self):
+        """
+        Tail all the stacks until none of them are in progress. Returns the final status of each stack.
+        """
+        tailers = {}
+        due = []
+        for name in self.stack_names:
+            tailer = EventTailer(self.cfconn, name)
+            events = tailer.start()
+            for event in events:
+                self.log_event(event, name)
+            if not self.in_progress(tailer.status):
+                self.logger.info("Stack %s is %s, not waiting on it" % (name, tailer.status))
+                self.results[name] = tailer.status
+                continue
+            self.logger.info("Watching stack %s, while in state %s." % (name, tailer.status))
+            tailers[name] = tailer
+            heapq.heappush(due, (time.time() + tailer.next_delay(), name))
+
+        last_call = 0
+        while due:
+            when, name = heapq.heappop(due)
+            #Wait for this stack's next poll, and keep polls across all stacks at least min_gap apart
+            delay = max(when, last_call + self.min_gap) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            last_call = time.time()
+            tailer = tailers[name]
+            for event in tailer.poll():
+                self.log_event(event, name)
+            if self.in_progress(tailer.status):
+                heapq.heappush(due, (time.time() + tailer.next_delay(), name))
+            else:
+                self.logger.info("Stack %s finished with status %s, %s stacks still in progress" % (name, tailer.status, len(due)))
+                self.results[name] = tailer.status
+        return self.results
@@ -0,0 +1,87 @@
+import simplejson
+
+
+class TemplateDiff:
+    """
+    Structural diff between two versions of a cloudformation template, and optionally their parameters.
+    Entries in the top level sections (Resources, Outputs, Parameters etc.) are matched by logical ID,
+    so changes are reported as added, removed or modified resources with the JSON path of each changed
+    property, rather than as a text diff. Parameter values are reported under $.ParameterValues.
+    Only entries that aren't equal are walked, so large templates with a few changes are cheap to diff.
+    """
+    #Sections of a template whose entries are keyed by logical ID
+    KEYED_SECTIONS = ('Parameters', 'Mappings', 'Conditions', 'Resources', 'Outputs')
+
+    def __init__(self, old_template, new_template, old_params = None, new_params = None):
+        #List of (change, path, old value, new value), change is one of added, removed or modified
+        self.changes = []
+        if old_template is not None and new_template is not None:
+            self.diff_templates(old_template, new_template)
+        if old_params is not None and new_params is not None:
+            self.diff_keyed('$.ParameterValues', old_params, new_params)
+
+    def diff_templates(self, old, new):
+        for section in sorted(set(old.keys()) | set(new.keys())):
+            path = "$.%s" % section
+            if section in self.KEYED_SECTIONS and type(old.get(section, {})) is dict and type(new.get(section, {})) is dict:
+                self.diff_keyed(path, old.get(section, {}), new.get(section, {}))
+            else:
+                self.diff_value(path, old.get(section), new.get(section), section in old, section in new)
+
+    def diff_keyed(self, path, old, new):
+        """
+        Diff two dicts of entries keyed by logical ID, only walking the entries that have changed
+        """
+        for key in sorted(set(old.keys()) | set(new.keys())):
+            key_path = "%s.%s" % (path, key)
+            if key not in new:
+                self.changes.append(('removed', key_path, old[key], None))
+            elif key not in old:
+                self.changes.append(('added', key_path, None, new[key]))
+            elif old[key] != new[key]:
+                self.diff_value(key_path, old[key], new[key])
+
+    def diff_value(self, path, old, new, in_old = True, in_new = True):
+        if not in_new:
+            self.changes.append(('removed', path, old, None))
+        elif not in_old:
+            self.changes.append(('added', path, None, new))
+        elif old == new:
+            return
+        elif type(old) is dict and type(new) is dict:
+            for key in sorted(set(old.keys()) | set(new.keys())):
+                self.diff_value("%s.%s" % (path, key), old.get(key), new.get(key), key in old, key in new)
+        elif type(old) is list and type(new) is list:
+            for i in range(max(len(old), len(new))):
+                self.diff_value("%s[%s]" % (path, i), old[i] if i < len(old) else None, new[i] if i < len(new) else None, i < len(old), i < len(new))
+        else:
+            self.changes.append(('modified', path, old, new))
+
+    def short_value(self, value, max_length = 80):
+        text = simplejson.dumps(value, sort_keys=True, separators=(',', ':'))
+        if len(text) > max_length:
+            text = text[:max_length - 3] + '...'
+        return text
+
+    def lines(self):
+        """
+        The changes as lines of text, + for added, - for removed and ~ for modified
+        """
+        lines = []
+        for change, path, old, new in self.changes:
+            if change == 'added':
+                if type(new) is dict and 'Type' in new:
+                    lines.append("+ %s (%s)" % (path, new['Type']))
+                else:
+                    lines.append("+ %s: %s" % (path, self.short_value(new)))
+            elif change == 'removed':
+                if type(old) is dict and 'Type' in old:
+                    lines.append("- %s (%s)" % (path, old['Type']))
+                else:
+                    lines.append("- %s: %s" % (path, self.short_value(old)))
+            else:
+                lines.append("~ %s: %s -> %s" % (path, self.short_value(old), self.short_value(new)))
+        return lines
+
+    def __len__(self):
+        return len(self.changes)
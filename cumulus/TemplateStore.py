@@ -0,0 +1,60 @@
+import hashlib
+import logging
+import threading
+import boto.s3
+
+
+class TemplateStore:
+    """
+    Stores templates in an S3 bucket so they can be passed to cloudformation as a template_url
+    rather than inline, which gets around the limit on the size of inline templates.
+    Templates are stored under a key made from the SHA-256 of their contents, so a template that
+    hasn't changed is already in the bucket and costs a single HEAD request instead of an upload.
+    When offline nothing is uploaded, templates are still treated as passed by URL for their size limit.
+    """
+    def __init__(self, bucket_name, region, prefix = '', s3conn = None, offline = False):
+        self.logger = logging.getLogger(__name__)
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.offline = offline
+        self.bucket = None
+        if not offline:
+            if s3conn is None:
+                s3conn = boto.s3.connect_to_region(region)
+            self.bucket = s3conn.get_bucket(bucket_name, validate = False)
+        self.lock = threading.Lock()
+        #URLs of templates we already know are in the bucket, keyed by key name
+        self.urls = {}
+        #One lock per key, so stacks sharing a template only check for and upload it once
+        self.key_locks = {}
+
+    def _key_lock(self, key_name):
+        with self.lock:
+            return self.key_locks.setdefault(key_name, threading.Lock())
+
+    def key_name(self, template_body):
+        return "%s%s.json" % (self.prefix, hashlib.sha256(template_body).hexdigest())
+
+    def store(self, template_body):
+        """
+        Make sure a template is in the bucket, uploading it if it isn't, and return its URL.
+        Returns None when offline.
+        """
+        if self.offline:
+            return None
+        key_name = self.key_name(template_body)
+        with self._key_lock(key_name):
+            #Another thread may have stored it while we were waiting
+            if key_name in self.urls:
+                return self.urls[key_name]
+            key = self.bucket.get_key(key_name)
+            if key is None:
+                self.logger.info("Uploading template to s3://%s/%s" % (self.bucket_name, key_name))
+                key = self.bucket.new_key(key_name)
+                key.set_contents_from_string(template_body, headers = {'Content-Type': 'application/json'})
+            else:
+                self.logger.debug("Template already in s3://%s/%s" % (self.bucket_name, key_name))
+            url = key.generate_url(0, query_auth = False)
+            with self.lock:
+                self.urls[key_name] = url
+            return url
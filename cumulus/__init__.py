@@ -5,26 +5,72 @@
 
 import argparse
 import logging
+import simplejson
 import time
 from boto import cloudformation
+from CFConnectionPool import CFConnectionPool
+from DurationHistory import DurationHistory
+from FingerprintCache import FingerprintCache
+from InputManifest import InputManifest
 from MegaStack import MegaStack
+from RunJournal import RunJournal, JournalError
+from RegionSnapshot import SnapshotError, load_snapshot
 
 def main():
 
     conf_parser = argparse.ArgumentParser()
     conf_parser.add_argument("-y", "--yamlfile", dest="yamlfile", required=True, help="The yaml file to read the VPC mega stack configuration from")
-    conf_parser.add_argument("-a", "--action", dest="action", required=True, help="The action to preform: create, check, update, delete or watch")
+    conf_parser.add_argument("-a", "--action", dest="action", required=True, help="The action to preform: create, check, update, diff, plan, apply, snapshot, delete or watch")
     conf_parser.add_argument("-l", "--log", dest="loglevel", required=False, default="info", help="Log Level for output messages, CRITICAL, ERROR, WARNING, INFO or DEBUG")
     conf_parser.add_argument("-L", "--botolog", dest="botologlevel", required=False, default="critical", help="Log Level for boto, CRITICAL, ERROR, WARNING, INFO or DEBUG")
-    conf_parser.add_argument("-s", "--stack", dest="stackname", required=False, help="The stack name, used with the watch action, ignored for other actions")
+    conf_parser.add_argument("-s", "--stack", dest="stackname", required=False, help="The stack name, used with the watch action, ignored for other actions. The watch action also accepts a comma separated list of stacks")
+    conf_parser.add_argument("--all", dest="watch_all", required=False, action="store_true", default=False, help="Watch every stack in the yaml file, used with the watch action")
+    conf_parser.add_argument("-p", "--parallel", dest="parallel", required=False, type=int, default=1, help="Maximum number of stacks to work on at once for the create, update, apply and delete actions. Default is 1 (one at a time)")
+    conf_parser.add_argument("--keep-going", dest="keep_going", required=False, action="store_true", default=False, help="When a stack fails, skip only the stacks that depend on it and carry on with the rest, used with the create, update, apply and delete actions")
+    conf_parser.add_argument("--resume", dest="resume", required=False, action="store_true", default=False, help="Carry on from where the last create or update stopped, skipping the stacks it finished. Only used with the create and update actions")
+    conf_parser.add_argument("--journal-file", dest="journal_file", required=False, help="The file create and update record their progress in, for --resume. Defaults to the yaml file name with .journal on the end")
+    conf_parser.add_argument("--changed-only", dest="changed_only", required=False, action="store_true", default=False, help="Only check and update the stacks whose template file, params, tags or SNS topics have changed since they were last in sync with cloudformation, and the stacks that depend on them. Only used with the update action")
+    conf_parser.add_argument("--manifest-file", dest="manifest_file", required=False, help="The file to record the inputs of each stack in once it's in sync with cloudformation, for --changed-only. Defaults to the yaml file name with .manifest on the end")
+    conf_parser.add_argument("--pool-size", dest="pool_size", required=False, type=int, default=10, help="Maximum number of concurrent connections to cloudformation per region. Default is 10")
+    conf_parser.add_argument("--read-rate", dest="read_rate", required=False, type=float, default=10, help="Maximum calls per second to cloudformation that only read, like describe_stacks. 0 for no limit. Default is 10")
+    conf_parser.add_argument("--write-rate", dest="write_rate", required=False, type=float, default=5, help="Maximum calls per second to cloudformation that create, update or delete stacks. 0 for no limit. Default is 5")
+    conf_parser.add_argument("--max-retries", dest="max_retries", required=False, type=int, default=5, help="Times to retry a call cloudformation throttles, backing off exponentially. Default is 5")
+    conf_parser.add_argument("--diff", dest="show_diff", required=False, action="store_true", default=False, help="Show the changes to each stack before updating it, used with the update action")
+    conf_parser.add_argument("--plan-file", dest="plan_file", required=False, help="The file the plan action saves the plan to and the apply action reads it from. Defaults to the yaml file name with .plan on the end")
+    conf_parser.add_argument("--snapshot-file", dest="snapshot_file", required=False, help="The file the snapshot action saves to and --from-snapshot reads from. Defaults to the yaml file name with .snapshot on the end")
+    conf_parser.add_argument("--from-snapshot", dest="from_snapshot", required=False, action="store_true", default=False, help="Read everything from the snapshot file instead of cloudformation, used with the check, plan and diff actions")
+    conf_parser.add_argument("--history-file", dest="history_file", required=False, help="The file to record how long each stack takes to create, update and delete in, used to start the slowest chains of stacks first and estimate how long a run will take. Defaults to the yaml file name with .history on the end")
+    conf_parser.add_argument("--fingerprint-file", dest="fingerprint_file", required=False, help="The file to remember the fingerprints of stacks found up to date that cumulus didn't tag, so their templates don't have to be fetched on every update. Defaults to the yaml file name with .fingerprints on the end")
+    conf_parser.add_argument("--metrics-json", dest="metrics_json", required=False, help="Write counts and latencies of the cloudformation API calls made to this file as JSON")
+    conf_parser.add_argument("--metrics-prom", dest="metrics_prom", required=False, help="Write counts and latencies of the cloudformation API calls made to this file in the Prometheus text format")
+    conf_parser.add_argument("--yes", dest="assume_yes", required=False, action="store_true", default=False, help="Don't prompt for confirmation before deleting stacks")
     args = conf_parser.parse_args()
 
     #Validate that action is something we know what to do with
-    valid_actions = ['create', 'check', 'update', 'delete', 'watch']
+    valid_actions = ['create', 'check', 'update', 'diff', 'plan', 'apply', 'snapshot', 'delete', 'watch']
     if args.action not in valid_actions:
         print "Invalid action provided, must be one of: '%s'" % ( ", ".join(valid_actions) )
         exit(1)
 
+    if args.parallel < 1:
+        print "Invalid value for parallel, must be 1 or more"
+        exit(1)
+    if args.resume and args.action not in ['create', 'update']:
+        print "--resume can only be used with the create and update actions"
+        exit(1)
+    if args.changed_only and args.action != 'update':
+        print "--changed-only can only be used with the update action"
+        exit(1)
+    if args.read_rate < 0 or args.write_rate < 0 or args.max_retries < 0:
+        print "Invalid value for read rate, write rate or max retries, can't be negative"
+        exit(1)
+    if args.from_snapshot and args.action not in ['check', 'plan', 'diff']:
+        print "--from-snapshot can only be used with the check, plan and diff actions"
+        exit(1)
+    if args.pool_size < 1:
+        print "Invalid value for pool size, must be 1 or more"
+        exit(1)
+
     #Make sure we can read the yaml file provided
     try:
         readable = open(args.yamlfile, 'r')
@@ -48,31 +94,94 @@ def main():
     logging.getLogger('boto').setLevel(boto_numeric_level)
 
     #Create the mega_stack object and sort out dependencies
-    the_mega_stack = MegaStack(args.yamlfile)
-    the_mega_stack.sort_stacks_by_deps()
+    snapshot_file = args.snapshot_file or "%s.snapshot" % args.yamlfile
+    the_snapshot = None
+    if args.from_snapshot:
+        try:
+            the_snapshot = load_snapshot(snapshot_file)
+        except SnapshotError as e:
+            logger.critical(str(e))
+            exit(1)
+        logger.info("Working from snapshot %s taken at %s" % (snapshot_file, the_snapshot.created))
+        cf_pool = CFConnectionPool(size=args.pool_size, connect=the_snapshot.connect)
+    else:
+        cf_pool = CFConnectionPool(size=args.pool_size, read_rate=args.read_rate, write_rate=args.write_rate, max_retries=args.max_retries)
+    duration_history = DurationHistory(args.history_file or "%s.history" % args.yamlfile)
+    input_manifest = InputManifest(args.manifest_file or "%s.manifest" % args.yamlfile)
+    fingerprint_cache = FingerprintCache(args.fingerprint_file or "%s.fingerprints" % args.yamlfile)
+    try:
+        the_mega_stack = MegaStack(args.yamlfile, cf_pool=cf_pool, from_snapshot=the_snapshot, duration_history=duration_history, input_manifest=input_manifest, fingerprint_cache=fingerprint_cache)
+        the_mega_stack.sort_stacks_by_deps()
+
+        #Print some info about what we found in the yaml and dependency order
+        logger.info("Mega stack name: %s" % the_mega_stack.name)
+        logger.info("Found %s CF stacks in yaml." % len(the_mega_stack.cf_stacks))
+        logger.info("Processing stacks in the following order: %s" % [x.name for x in the_mega_stack.stack_objs])
+        for stack in the_mega_stack.stack_objs:
+            logger.debug("%s depends on %s" % (stack.name, stack.depends_on))
+
+        #Creates and updates record their progress in a journal, so they can be resumed if they're stopped
+        journal = None
+        if args.action in ['create', 'update']:
+            try:
+                journal = RunJournal(args.journal_file or "%s.journal" % args.yamlfile, args.action, the_mega_stack.name, resume=args.resume)
+            except JournalError as e:
+                logger.critical(str(e))
+                exit(1)
+            except IOError as e:
+                logger.warning("Can't open the journal, carrying on without one so this run can't be resumed: %s" % e)
+
+        #Run the method of the mega stack object for the action provided
+        if args.action == 'create':
+            the_mega_stack.create(args.stackname, parallel=args.parallel, keep_going=args.keep_going, journal=journal)
+
+        if args.action == 'check':
+            the_mega_stack.check(args.stackname)
+
+        if args.action == 'delete':
+            the_mega_stack.delete(args.stackname, parallel=args.parallel, assume_yes=args.assume_yes, keep_going=args.keep_going)
+
+        if args.action == 'update':
+            the_mega_stack.update(args.stackname, parallel=args.parallel, show_diff=args.show_diff, keep_going=args.keep_going, journal=journal, changed_only=args.changed_only)
+
+        if args.action == 'diff':
+            the_mega_stack.diff(args.stackname)
+
+        plan_file = args.plan_file or "%s.plan" % args.yamlfile
+        if args.action == 'plan':
+            the_mega_stack.plan(plan_file)
 
-    #Print some info about what we found in the yaml and dependency order
-    logger.info("Mega stack name: %s" % the_mega_stack.name)
-    logger.info("Found %s CF stacks in yaml." % len(the_mega_stack.cf_stacks))
-    logger.info("Processing stacks in the following order: %s" % [x.name for x in the_mega_stack.stack_objs])
-    for stack in the_mega_stack.stack_objs:
-        logger.debug("%s depends on %s" % (stack.name, stack.depends_on))
+        if args.action == 'apply':
+            the_mega_stack.apply(plan_file, parallel=args.parallel, keep_going=args.keep_going)
 
-    #Run the method of the mega stack object for the action provided
-    if args.action == 'create':
-        the_mega_stack.create(args.stackname)
+        if args.action == 'snapshot':
+            the_mega_stack.snapshot(snapshot_file)
 
-    if args.action == 'check':
-        the_mega_stack.check(args.stackname)
+        if args.action == 'watch':
+            the_mega_stack.watch(args.stackname, watch_all=args.watch_all)
 
-    if args.action == 'delete':
-        the_mega_stack.delete(args.stackname)
+        if journal is not None:
+            journal.close()
+    finally:
+        duration_history.save()
+        input_manifest.save()
+        fingerprint_cache.save()
+        report_metrics(cf_pool.metrics, args, logger)
 
-    if args.action == 'update':
-        the_mega_stack.update(args.stackname)
+    logger.debug("Connections made to cloudformation per region: %s" % cf_pool.connect_count)
 
-    if args.action == 'watch':
-        the_mega_stack.watch(args.stackname)
+def report_metrics(metrics, args, logger):
+    """
+    Log a summary of the cloudformation API calls made, and write them to the metrics files asked for
+    """
+    for line in metrics.summary_lines():
+        logger.info(line)
+    if args.metrics_json:
+        metrics_file = open(args.metrics_json, 'w')
+        simplejson.dump(metrics.as_dict(), metrics_file, sort_keys=True, indent=2)
+        metrics_file.close()
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
 
 if __name__ == '__main__':
     main()